@@ -0,0 +1,127 @@
+#
+#   Historical backfill for the NED solar forecast plugin
+#
+#   Author: Jan-Jaap Kostelijk
+#
+#   Fetches past NED forecasts and actuals for a long date range into the local
+#   history store (historyStore). The range is split in chunks of a few days per
+#   point and classification, which are fetched concurrently by a small thread
+#   pool sharing one rate limited NedClient. Chunks already in the store are
+#   skipped, so an interrupted backfill continues where it stopped. Chunks of
+#   the last few days are fetched again on every run until their measured
+#   values are published. Usage:
+#       python backfill.py --key APIKEY --start 2025-01-01 --end 2026-01-01 [--points 0,1,...] [--db history.db]
+#
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+
+import requests
+
+from historyStore import HistoryStore
+from nedClient import NedClient
+
+POINTS = tuple(str(code) for code in range(13))
+CLASSIFICATIONS = (1, 2)  # forecast, current (measured)
+# days per chunk for the granularity codes, so a chunk fits in one page of 200 records
+CHUNK_DAYS = {3: 1, 4: 2, 5: 8, 6: 180}
+# days before measured values are complete, chunks ending within them are stored but fetched again on the next run
+PUBLICATION_LAG = 3
+
+def chunks(start, end, days):
+    """(start, end) date pairs of at most days days covering start (inclusive) to end (exclusive)"""
+    while start < end:
+        stop = min(end, start + timedelta(days=days))
+        yield start, stop
+        start = stop
+
+def chunkParams(point, classification, granularity, start, end):
+    """NED API query parameters for one chunk"""
+    return {
+        'point': point,
+        'type': 2,  # Solar
+        'granularity': granularity,
+        'granularitytimezone': 1,  # CET (Central European Time)
+        'classification': classification,
+        'activity': 1,  # Providing (production)
+        'validfrom[after]': str(start),
+        'validfrom[strictly_before]': str(end)
+    }
+
+def backfill(client, store, start, end, points=POINTS, classifications=CLASSIFICATIONS, granularity=5, days=None, workers=4, itemsPerPage=200, log=print):
+    """Fetch all chunks from start to end not yet in the store, returns (chunks stored, chunks failed)"""
+    days = days or CHUNK_DAYS.get(granularity, 8)
+    settled = date.today() - timedelta(days=PUBLICATION_LAG)
+    done = store.done(granularity)
+    todo = [(point, classification, chunkStart, chunkEnd)
+            for point in points for classification in classifications for chunkStart, chunkEnd in chunks(start, end, days)
+            if (str(point), classification, str(chunkStart), str(chunkEnd)) not in done]
+    log(f"{len(todo)} chunks to fetch, {len(done)} already stored")
+
+    def fetch(point, classification, chunkStart, chunkEnd):
+        return list(client.records(chunkParams(point, classification, granularity, chunkStart, chunkEnd), itemsPerPage))
+
+    stored = failed = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="NEDbackfill") as pool:
+        futures = {pool.submit(fetch, *chunk): chunk for chunk in todo}
+        try:
+            for future in as_completed(futures):
+                point, classification, chunkStart, chunkEnd = futures[future]
+                try:
+                    records = future.result()
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    failed += 1
+                    log(f"Chunk {point}/{classification} {chunkStart}..{chunkEnd} failed: {str(e)}")
+                    continue
+                # written from this thread only, the chunk is marked done together with its records once
+                # it lies before the publication lag, a recent chunk may still be incomplete
+                store.put(point, classification, granularity, chunkStart, chunkEnd, records, final=chunkEnd <= settled)
+                stored += 1
+                if stored % 50 == 0:
+                    log(f"{stored}/{len(todo)} chunks stored")
+        except KeyboardInterrupt:
+            log("Interrupted, stored chunks are kept and skipped on the next run")
+            for future in futures:
+                future.cancel()
+            client.close()
+            raise
+    return stored, failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill past NED forecasts and actuals into a local history store")
+    parser.add_argument('--key', required=True, help="NED API key")
+    parser.add_argument('--start', required=True, type=date.fromisoformat, help="first day (YYYY-MM-DD)")
+    parser.add_argument('--end', default=None, type=date.fromisoformat, help="day after the last day (default: today)")
+    parser.add_argument('--points', default=",".join(POINTS), help="comma separated location codes (default: all 13)")
+    parser.add_argument('--classifications', default="1,2", help="1 forecast, 2 current, 3 backcast (default: 1,2)")
+    parser.add_argument('--granularity', type=int, default=5, help="NED granularity code, 4 = 15 minutes, 5 = hour (default)")
+    parser.add_argument('--days', type=int, default=None, help="days per chunk (default: one page of records)")
+    parser.add_argument('--workers', type=int, default=4, help="concurrent requests")
+    parser.add_argument('--db', default="history.db", help="history store file")
+    parser.add_argument('--url', default=None, help="NED API endpoint (e.g. a local fakeNED)")
+    parser.add_argument('--ratelimit', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'forecastcache.db.locks', 'ratelimit.json'),
+                        help="request limit state shared with the plugin instances (default: the one of the plugin in this folder, '' for none)")
+    args = parser.parse_args()
+
+    store = HistoryStore(args.db)
+    client = NedClient(args.key, url=args.url, log=print, bucketPath=args.ratelimit or None)
+    end = args.end or date.today()
+    points = [point.strip() for point in args.points.split(',') if point.strip()]
+    classifications = [int(value) for value in args.classifications.split(',') if value.strip()]
+    start = time.perf_counter()
+    try:
+        stored, failed = backfill(client, store, args.start, end, points, classifications, args.granularity, args.days, args.workers)
+    finally:
+        client.close()
+    print(f"{stored} chunks stored, {failed} failed in {time.perf_counter() - start:.1f} s, {store.count()} records in {args.db}")
+
+    # the query the store is made for: the whole range for every point
+    span = (datetime.combine(args.start, datetime.min.time()).timestamp(), datetime.combine(end, datetime.min.time()).timestamp())
+    start = time.perf_counter()
+    rows = sum(len(store.query(point, classification, *span, granularity=args.granularity)) for point in points for classification in classifications)
+    print(f"Range query of {rows} records took {(time.perf_counter() - start) * 1000:.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+#
+#   Offline benchmark suite for the NED solar forecast plugin
+#
+#   Author: Jan-Jaap Kostelijk
+#
+#   Measures getData, the solar correction (per record and batched) and
+#   updateDevices (hourly and quarter hour records) against fakeDomoticz and
+#   the local NED stand-in (fakeNED), across record counts, locations and panel orientations. Results are
+#   compared with the stored baseline. Usage:
+#       python benchmark.py [--repeat n] [--quick] [--save] [--baseline file]
+#
+import argparse
+import json
+import os
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import fakeDomoticz
+import plugin
+import solarGeometry
+from fakeNED import FakeNED, syntheticRecords
+from nedClient import TokenBucket
+
+RECORD_COUNTS = (48, 192, 2000, 20000)
+LOCATIONS = ('0', '12')
+AZIMUTHS = (-90, 0, 90)
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+def best(callback, repeat, setup=None):
+    """Fastest of repeat runs of callback in ms"""
+    timings = []
+    for run in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        callback()
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+def makePlugin(home, url):
+    """A started plugin instance on fakeDomoticz, with its first fetch completed"""
+    fakeDomoticz.reset()
+    plugin.Parameters.update({'Mode4': 'Normal', 'Mode5': 'benchmark', 'Address': '', 'Username': '', 'Port': '', 'HomeFolder': home})
+    instance = plugin.SolarForecastPlug()
+    instance.apiUrl = url
+    instance.onStart()
+    # the local stand-in has no rate limit
+    instance.client().bucket = TokenBucket(rate=1e6, capacity=1e6)
+    while instance.fetchWorker.busy():
+        time.sleep(0.01)
+    instance.fetchWorker.poll()
+    return instance
+
+def records(count, granularity=5):
+    start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return syntheticRecords('0', granularity, start, None, count)
+
+def benchCorrection(instance, counts, repeat):
+    results = {}
+    for count in counts:
+        data = records(count)
+        datelines = [datetime.fromisoformat(record['validfrom']) for record in data]
+        capacities = [record['capacity'] for record in data]
+        days = [dateline.timetuple().tm_yday for dateline in datelines]
+        hours = [dateline.hour for dateline in datelines]
+        for location_code in LOCATIONS:
+            location = instance.locations[location_code]
+            for azimuth in AZIMUTHS:
+                instance.az = azimuth
+                suffix = f"n={count}/loc={location_code}/az={azimuth}"
+                results[f"correction/scalar/{suffix}"] = best(lambda: [instance.calculate_solar_correction(hour, capacity, location_code, day)
+                                                                        for day, hour, capacity in zip(days, hours, capacities)], repeat)
+                results[f"correction/batch/{suffix}"] = best(lambda: solarGeometry.correctBatch(location['latitude'], location['longitude'],
+                                                                                                days, hours, capacities, azimuth, instance.kwp), repeat)
+                results[f"correction/table/{suffix}"] = best(lambda: instance.sunTable.correct(location_code, days, hours, capacities,
+                                                                                               azimuth, instance.kwp), repeat)
+    return results
+
+def benchGetData(instance, fake, counts, repeat):
+    results = {}
+    for count in counts:
+        fake.records = count
+        results[f"getData/n={count}"] = best(lambda: instance.getData(instance.location_code, refresh=True), repeat)
+    return results
+
+def benchUpdateDevices(instance, counts, repeat):
+    results = {}
+    for count in counts:
+        data = records(count)
+        results[f"updateDevices/all changed/n={count}"] = best(lambda: instance.updateDevices(data, instance.location_code), repeat,
+                                                               setup=instance.lastWritten.clear)
+        results[f"updateDevices/unchanged/n={count}"] = best(lambda: instance.updateDevices(data, instance.location_code), repeat)
+        # the same hours at quarter hour granularity, four times the records for the same hourly device values
+        data = records(4 * count, granularity=4)
+        results[f"updateDevices/quarter hour/all changed/n={4 * count}"] = best(lambda: instance.updateDevices(data, instance.location_code), repeat,
+                                                                                setup=instance.lastWritten.clear)
+    return results
+
+def report(results, baseline):
+    width = max(len(name) for name in results)
+    print(f"{'benchmark':<{width}}  {'ms':>10}  {'baseline':>10}  {'ratio':>6}")
+    for name, ms in results.items():
+        line = f"{name:<{width}}  {ms:>10.3f}"
+        if name in baseline:
+            line += f"  {baseline[name]:>10.3f}  {ms / baseline[name] if baseline[name] else float('nan'):>6.2f}"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the NED solar forecast plugin offline")
+    parser.add_argument('--repeat', type=int, default=5, help="runs per benchmark, the fastest counts")
+    parser.add_argument('--quick', action='store_true', help="only the two smallest record counts")
+    parser.add_argument('--save', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--baseline', default=BASELINE, help="baseline results file")
+    args = parser.parse_args()
+    counts = RECORD_COUNTS[:2] if args.quick else RECORD_COUNTS
+
+    fakeDomoticz.quiet = True
+    fake = FakeNED()
+    url = fake.start()
+    instance = makePlugin(tempfile.mkdtemp(prefix="NEDsolarForecast-bench-") + "/", url)
+    try:
+        results = {}
+        results.update(benchCorrection(instance, counts, args.repeat))
+        results.update(benchGetData(instance, fake, counts, args.repeat))
+        results.update(benchUpdateDevices(instance, counts, args.repeat))
+    finally:
+        instance.onStop()
+        fake.stop()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    report(results, baseline)
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'repeat': args.repeat, 'results': results}, f, indent=1)
+        print(f"Baseline written to {args.baseline}")
+
+if __name__ == "__main__":
+    main()
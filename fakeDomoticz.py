@@ -6,12 +6,39 @@
 #   Very simple module to make local testing easier
 #   It "emulates" Domoticz.Log(), Domoticz.Error and Domoticz.Debug()
 #   It also emulates the Device and Unit from the Ex framework
+#   Units record every Update() and all log lines are recorded as well, set
+#   quiet to True to stop printing them (e.g. when benchmarking)
 #
+from collections import deque
 from datetime import datetime
 Devices = dict()
-Parameters = {"Mode1": 45, "Mode2": -90, "Mode3" : 4.8, "Mode4": "Debug", "Mode5": "", "Mode6": 6, "Port": 8443, "Username": "mail@domain.com" , "Password": "aNicerp@ssword", "Version" : "0.0.0", "HomeFolder":"/home/pi/domoticz/plugins/SessyBattery/", "Name": "fakeDomoticz"}
+Parameters = {"Mode1": "45", "Mode2": "-90", "Mode3" : "4.8", "Mode4": "Debug", "Mode5": "", "Mode6": "6", "Port": 8443, "Username": "mail@domain.com" , "Password": "aNicerp@ssword", "Version" : "0.0.0", "HomeFolder":"/home/pi/domoticz/plugins/SessyBattery/", "Name": "fakeDomoticz"}
 Settings = {"Language":"NL", 'Location':'52.0;4.0'}
 config = dict()
+quiet = False
+messages = deque(maxlen=1000)
+
+def output(level, s):
+    messages.append((level, s))
+    if not quiet:
+        print(s)
+
+def updateCount():
+    """Total number of Update() calls on all units"""
+    return sum(len(unit.history) for device in Devices.values() for unit in device.Units.values())
+
+def reset():
+    """Remove all devices and recorded messages"""
+    Devices.clear()
+    messages.clear()
+
+class myDevice:
+    def __init__(self, DeviceID=""):
+        self.DeviceID=DeviceID
+        self.Units = dict()
+
+    def __str__(self):
+        return "DeviceID: "+str(self.DeviceID)+", units: "+str(list(self.Units))
 
 class myUnit:
     def __init__(self,Name="label", Unit=0, Type=0, TypeName ="", Subtype=0, Switchtype=0, Options="", DeviceID="deviceURL", Used=0, Image=0):
@@ -23,9 +50,22 @@ class myUnit:
         self.Switchtype=Switchtype
         self.DeviceID=DeviceID
         self.Used=Used
+        self.Options=Options
+        self.ID=0
+        self.nValue=0
+        self.sValue=""
+        self.history=[]
 
     def Create(self):
-        print("Creating unit "+str(self.Name)+" for deviceID "+str(self.DeviceID))
+        output("Status", "Creating unit "+str(self.Name)+" for deviceID "+str(self.DeviceID))
+        if self.DeviceID not in Devices:
+            Devices[self.DeviceID] = myDevice(self.DeviceID)
+        self.ID = sum(len(d.Units) for d in Devices.values()) + 1
+        Devices[self.DeviceID].Units[self.Unit] = self
+
+    def Update(self):
+        self.history.append((datetime.now(), self.nValue, self.sValue))
+        output("Status", "Updating unit "+str(self.Name)+": nValue="+str(self.nValue)+", sValue="+str(self.sValue))
 
     @property
     def LastUpdate(self):
@@ -38,26 +78,26 @@ class Domoticz:
         return
 
     def Log(self, s):
-        print(s)
+        output("Log", s)
 
     def Status(self, s):
-        print(s)
+        output("Status", s)
 
     def Error(self, s):
-        print(s)
+        output("Error", s)
 
     def Debug(self, s):
-        print(s)
+        output("Debug", s)
     
     def Debugging(self, level):
-        print("debugging set to "+ str(level))
+        output("Status", "debugging set to "+ str(level))
     
     def Heartbeat(self, level):
-        print("heartbeat set to "+ str(level))
+        output("Status", "heartbeat set to "+ str(level))
     
     def Device(self, DeviceID=""):
         self.Devices[DeviceID] = DeviceID
-        print("creating DeviceID: "+ DeviceID)
+        output("Status", "creating DeviceID: "+ DeviceID)
 
     def Unit(self, Name="label", Unit=0, Type=0, TypeName="", Subtype=0, Switchtype=0, Options="", DeviceID="deviceURL", Used=0, Image=0):
         newUnit = myUnit(Name, Unit, Type, TypeName, Subtype, Switchtype, Options, DeviceID, Used)
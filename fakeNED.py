@@ -0,0 +1,159 @@
+#
+#   Fake NED - local stand-in for the NED utilizations API
+#
+#   Author: Jan-Jaap Kostelijk
+#
+#   Serves recorded or synthetic utilization records on a local HTTP server so
+#   the plugin can be tested and benchmarked without the live API. Latency,
+#   error responses and the maximum page size are configurable. Usage:
+#       python fakeNED.py [--port 8080] [--latency seconds] [--errors fraction] [--payload recorded.json]
+#
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# seconds per record for the NED granularity codes
+GRANULARITY_STEP = {3: 600, 4: 900, 5: 3600, 6: 86400}
+
+def syntheticCount(granularity, start, end):
+    """Number of synthetic records from start (inclusive) to end (exclusive)"""
+    step = GRANULARITY_STEP.get(granularity, 3600)
+    return max(0, -(-int((end - start).total_seconds()) // step))
+
+def syntheticRecords(point, granularity, start, end, count=None, offset=0):
+    """Solar shaped utilization records from start (inclusive) to end (exclusive), or count records from start
+
+    offset skips the first records, so a single page can be generated without the ones before it.
+    """
+    step = timedelta(seconds=GRANULARITY_STEP.get(granularity, 3600))
+    scale = 0.8 + 0.02 * (int(point) % 10)
+    if count is None:
+        count = syntheticCount(granularity, start, end)
+    records = []
+    moment = start + offset * step
+    while offset + len(records) < count:
+        hour = moment.hour + moment.minute / 60
+        capacity = round(max(0.0, 60 * scale * math.sin(math.pi * (hour - 5) / 16)) if 5 < hour < 21 else 0.0, 3)
+        records.append({
+            'point': f"/v1/points/{point}",
+            'type': '/v1/types/2',
+            'granularity': f"/v1/granularities/{granularity}",
+            'validfrom': moment.isoformat(),
+            'validto': (moment + step).isoformat(),
+            'capacity': capacity,
+            'volume': round(capacity * 1000, 1),
+            'percentage': round(capacity / 100, 5)
+        })
+        moment += step
+    return records
+
+class FakeNED:
+    """Local HTTP stand-in for https://api.ned.nl/v1/utilizations"""
+
+    def __init__(self, payload=None, latency=0.0, errors=0.0, errorStatus=503, pageSize=None, records=None, port=0):
+        self.payload = payload  # recorded records, None for synthetic data
+        self.latency = latency  # seconds added to every response
+        self.errors = errors  # fraction of requests answered with errorStatus
+        self.errorStatus = errorStatus
+        self.pageSize = pageSize  # maximum itemsPerPage the server honours
+        self.records = records  # synthetic record count per query, None to cover the requested date range
+        self.port = port
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}/v1/utilizations"
+
+    def query(self, params, offset, limit):
+        """The records matching the query parameters, limit records from offset"""
+        point = params.get('point', '0')
+        start = datetime.fromisoformat(params.get('validfrom[after]', str(datetime.now().date()))).replace(tzinfo=timezone.utc)
+        end = datetime.fromisoformat(params.get('validfrom[strictly_before]', str(start.date() + timedelta(days=2)))).replace(tzinfo=timezone.utc)
+        if self.payload is None:
+            granularity = int(params.get('granularity', 5))
+            total = self.records if self.records is not None else syntheticCount(granularity, start, end)
+            return syntheticRecords(point, granularity, start, end, min(total, offset + limit), offset)
+        records = [record for record in self.payload
+                   if start <= datetime.fromisoformat(record['validfrom']).astimezone(timezone.utc) < end]
+        return records[offset:offset + limit]
+
+    def respond(self, path):
+        """Return (status, headers, body) for a GET of path"""
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.errors and random.random() < self.errors:
+            headers = {'Retry-After': '1'} if self.errorStatus == 429 else {}
+            return self.errorStatus, headers, b'{"detail": "simulated error"}'
+        params = {key: values[0] for key, values in parse_qs(urlparse(path).query).items()}
+        itemsPerPage = int(params.get('itemsPerPage', 200))
+        if self.pageSize:
+            itemsPerPage = min(itemsPerPage, self.pageSize)
+        page = int(params.get('page', 1))
+        body = json.dumps(self.query(params, (page - 1) * itemsPerPage, itemsPerPage)).encode()
+        return 200, {'Content-Type': 'application/json'}, body
+
+    def start(self):
+        """Start serving on a background thread, returns the endpoint URL"""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                status, headers, body = fake.respond(self.path)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(name="fakeNED", target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the NED utilizations API")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument('--errors', type=float, default=0.0, help="fraction of requests answered with an error")
+    parser.add_argument('--status', type=int, default=503, help="HTTP status of the error responses")
+    parser.add_argument('--pagesize', type=int, default=None, help="maximum records per page")
+    parser.add_argument('--payload', default=None, help="JSON file with recorded utilization records to replay")
+    args = parser.parse_args()
+
+    payload = None
+    if args.payload:
+        with open(args.payload) as f:
+            payload = json.load(f)
+    fake = FakeNED(payload, args.latency, args.errors, args.status, args.pagesize, port=args.port)
+    print(f"Serving on {fake.start()}, press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        fake.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#
+#   Background fetch worker for the NED solar forecast plugin
+#
+#   Author: Jan-Jaap Kostelijk
+#
+#   Runs the blocking NED API calls on a small pool of threads so the Domoticz
+#   plugin thread (onHeartbeat) never waits on the network. The heartbeat only
+#   queues requests and collects finished results. Jobs run concurrently, so a
+#   slow or failing job does not hold up the others.
+#
+import queue
+import threading
+import time
+
+class FetchWorker:
+    """Execute fetch jobs on background threads and hand the results back to the heartbeat"""
+
+    def __init__(self, fetch, name="NEDfetch", workers=1):
+        self.fetch = fetch
+        self.name = name
+        self.workers = workers
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self):
+        """Start the worker threads (no-op when they are already running)"""
+        self.threads = [thread for thread in self.threads if thread.is_alive()]
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(name=f"{self.name}-{len(self.threads) + 1}", target=self.run, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def request(self, *args):
+        """Queue a fetch job, returns False when an identical job is still pending"""
+        with self.lock:
+            if args in self.pending:
+                return False
+            self.pending.add(args)
+        self.jobs.put(args)
+        return True
+
+    def busy(self):
+        with self.lock:
+            return len(self.pending) > 0
+
+    def poll(self):
+        """Return all completed (args, result) tuples without blocking"""
+        done = []
+        while True:
+            try:
+                done.append(self.results.get_nowait())
+            except queue.Empty:
+                return done
+
+    def stop(self, timeout=10):
+        """Ask the workers to finish and wait for them, returns True when all threads have ended"""
+        for thread in self.threads:
+            self.jobs.put(None)
+        deadline = time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        self.threads = [thread for thread in self.threads if thread.is_alive()]
+        return len(self.threads) == 0
+
+    def run(self):
+        while True:
+            args = self.jobs.get()
+            if args is None:
+                break
+            try:
+                result = self.fetch(*args)
+            except Exception as e:
+                result = e
+            with self.lock:
+                self.pending.discard(args)
+            self.results.put((args, result))
@@ -0,0 +1,333 @@
+#
+#   Columnar forecast container for the NED solar forecast plugin
+#
+#   Author: Jan-Jaap Kostelijk
+#
+#   Holds a forecast as typed columns instead of the list of dicts the NED API
+#   returns: validfrom as epoch seconds with its UTC offset, the capacity and,
+#   once corrected, the kWh per panel array. The ISO timestamps are parsed once
+#   at ingest (vectorized with NumPy when it is installed). Records are kept in
+#   time order with an index of the rows per local day, so a day or hour is a
+#   slice and the daily totals come from prefix sums. A forecast streamed in page
+#   by page is built from per chunk Forecasts with a ForecastBuilder.
+#
+import bisect
+from array import array
+from datetime import date, datetime
+
+from lazyModule import lazyImport
+
+np = lazyImport('numpy')  # None when NumPy is not installed
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+ISO_LENGTH = len("2025-01-01T00:00:00+01:00")
+
+def column(typecode, values):
+    """Typed column: a NumPy array, or an array.array without NumPy"""
+    if np is not None:
+        return np.asarray(values, dtype={'q': np.int64, 'l': np.int32, 'd': np.float64}[typecode])
+    return array(typecode, values)
+
+def parseTimes(strings):
+    """Return (epoch seconds, UTC offsets in seconds) of ISO 8601 timestamps with offset"""
+    if np is not None and strings and all(len(text) == ISO_LENGTH for text in strings):
+        digits = np.array(strings, dtype=f'U{ISO_LENGTH}').view(np.uint32).reshape(len(strings), ISO_LENGTH).astype(np.int64)
+        # only 'YYYY-MM-DDTHH:MM:SS+HH:MM' is parsed here, anything else goes through fromisoformat
+        if all((digits[:, index] == ord(char)).all() for index, char in ((4, '-'), (7, '-'), (10, 'T'), (13, ':'), (16, ':'), (22, ':'))) \
+                and np.isin(digits[:, 19], (ord('+'), ord('-'))).all():
+            digits -= ord('0')
+            number = lambda start, stop: sum(digits[:, index] * 10 ** (stop - 1 - index) for index in range(start, stop))
+            year, month, day = number(0, 4), number(5, 7), number(8, 10)
+            seconds = number(11, 13) * 3600 + number(14, 16) * 60 + number(17, 19)
+            offsets = (number(20, 22) * 3600 + number(23, 25) * 60) * np.where(digits[:, 19] == ord('-') - ord('0'), -1, 1)
+            # days since 1970-01-01 of the civil date
+            year = year - (month <= 2)
+            era = year // 400
+            yearOfEra = year - era * 400
+            dayOfYear = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+            days = era * 146097 + yearOfEra * 365 + yearOfEra // 4 - yearOfEra // 100 + dayOfYear - 719468
+            return days * 86400 + seconds - offsets, offsets
+    times, offsets = [], []
+    for text in strings:
+        moment = datetime.fromisoformat(text)
+        offset = moment.utcoffset()
+        offset = int(offset.total_seconds()) if offset is not None else 0
+        times.append((moment.toordinal() - EPOCH_ORDINAL) * 86400 + moment.hour * 3600 + moment.minute * 60 + moment.second - offset)
+        offsets.append(offset)
+    return times, offsets
+
+def sortColumns(times, *columns):
+    """The columns in the order of times, the NED API returns records in time order so usually nothing moves"""
+    if np is not None:
+        times = np.asarray(times, dtype=np.int64)
+        columns = [np.asarray(values) for values in columns]
+        if len(times) > 1 and (np.diff(times) < 0).any():
+            order = np.argsort(times, kind='stable')
+            return [times[order]] + [values[order] for values in columns]
+        return [times] + columns
+    if any(later < earlier for earlier, later in zip(times, times[1:])):
+        order = sorted(range(len(times)), key=times.__getitem__)
+        return [[values[index] for index in order] for values in [times] + list(columns)]
+    return [times] + list(columns)
+
+def inferStep(times):
+    """Seconds per record without validto: the shortest distance between records, an hour for a single record"""
+    if np is not None:
+        gaps = np.diff(np.asarray(times, dtype=np.int64))
+        gaps = gaps[gaps > 0].tolist()
+    else:
+        gaps = [later - earlier for earlier, later in zip(times, times[1:]) if later > earlier]
+    return int(min(gaps)) if gaps else 3600
+
+class Forecast:
+    """Forecast records as typed columns, in time order"""
+
+    def __init__(self, times, offsets, capacities, step=3600):
+        self.times = column('q', times)  # validfrom, epoch seconds
+        self.offsets = column('l', offsets)  # UTC offset of validfrom, seconds
+        self.capacities = column('d', capacities)  # percentage of the installed capacity (0-100)
+        self.step = step  # seconds per record
+        if np is not None:
+            self.local = self.times + self.offsets
+        else:
+            self.local = array('q', (moment + offset for moment, offset in zip(self.times, self.offsets)))
+        self.kwh = []  # corrected kWh per panel array, see setKwh
+        self.total = column('d', [])
+        self.cumulative = [0.0]
+        # local date -> (first row, row after the last) of that day
+        if np is not None:
+            days = self.local // 86400
+            bounds = [0] + (np.flatnonzero(np.diff(days)) + 1).tolist() + [len(self)]
+        else:
+            days = [moment // 86400 for moment in self.local]
+            bounds = [0] + [row for row in range(1, len(days)) if days[row] != days[row - 1]] + [len(days)]
+        self.dayIndex = {date.fromordinal(int(days[start]) + EPOCH_ORDINAL): (start, stop)
+                         for start, stop in zip(bounds, bounds[1:]) if stop > start}
+
+    @classmethod
+    def fromRecords(cls, records, log=None):
+        """Ingest utilization records (dicts as returned by the NED API), records without a valid time or capacity are skipped"""
+        if isinstance(records, cls):
+            return records
+        builder = ForecastBuilder()
+        for chunk in cls.chunks(records, None, log):
+            builder.add(chunk)
+        return builder.build()
+
+    @classmethod
+    def load(cls, data, log=None):
+        """Forecast of stored columns (see columns), or of utilization records"""
+        if isinstance(data, dict) and 'validfrom' in data:
+            return cls(data['validfrom'], data['offset'], data['capacity'], data['step'])
+        return cls.fromRecords(data, log)
+
+    def columns(self):
+        """The uncorrected forecast as plain lists, a compact form to store: step, validfrom (epoch), offset and capacity"""
+        return {'step': self.step, 'validfrom': self.times.tolist(), 'offset': self.offsets.tolist(), 'capacity': self.capacities.tolist()}
+
+    @classmethod
+    def chunks(cls, records, size=None, log=None):
+        """Yield a Forecast per size records of a stream of utilization records (one for all records without size)
+
+        The timestamps are parsed per chunk, so the records of a chunk can be dropped once it is built.
+        """
+        batch = []
+        for utilization in records:
+            batch.append(utilization)
+            if size and len(batch) >= size:
+                yield cls.parse(batch, log)
+                batch = []
+        if batch or not size:
+            yield cls.parse(batch, log)
+
+    @classmethod
+    def parse(cls, records, log=None):
+        """Forecast of a list of utilization records"""
+        validfrom, capacities = [], []
+        step = None
+        for utilization in records:
+            try:
+                moment = utilization.get('validfrom', '')
+                if not moment:
+                    continue
+                capacity = float(utilization.get('capacity', 0))
+                if step is None and utilization.get('validto'):
+                    step = int((datetime.fromisoformat(utilization['validto']) - datetime.fromisoformat(moment)).total_seconds())
+            except (AttributeError, KeyError, ValueError, TypeError) as e:
+                if log:
+                    log(f"Error processing utilization record: {str(e)}")
+                continue
+            validfrom.append(moment)
+            capacities.append(capacity)
+        try:
+            times, offsets = parseTimes(validfrom)
+        except ValueError:
+            # a malformed timestamp somewhere: parse one by one and drop the bad records
+            times, offsets, kept = [], [], []
+            for moment, capacity in zip(validfrom, capacities):
+                try:
+                    (seconds,), (offset,) = parseTimes([moment])
+                except ValueError as e:
+                    if log:
+                        log(f"Error processing utilization record: {str(e)}")
+                    continue
+                times.append(seconds)
+                offsets.append(offset)
+                kept.append(capacity)
+            capacities = kept
+        times, offsets, capacities = sortColumns(times, offsets, capacities)
+        return cls(times, offsets, capacities, step or inferStep(times))
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def end(self):
+        """Epoch seconds up to which the forecast has data, or None when it is empty"""
+        if not len(self):
+            return None
+        return int(self.times[-1]) + self.step
+
+    def days(self):
+        """The local dates in the forecast, in order"""
+        return list(self.dayIndex)
+
+    def dayOfYear(self):
+        """Local day of the year (1..366) of every record"""
+        if np is not None:
+            days = (self.local // 86400).astype('datetime64[D]')
+            return (days - days.astype('datetime64[Y]')).astype(np.int64) + 1
+        values = array('l')
+        for day, (start, stop) in self.dayIndex.items():
+            values.extend([day.timetuple().tm_yday] * (stop - start))
+        return values
+
+    def hours(self):
+        """Local hour of the day of every record, fractional for records within the hour"""
+        if np is not None:
+            return (self.local % 86400) / 3600
+        return array('d', (moment % 86400 / 3600 for moment in self.local))
+
+    def timestamps(self):
+        """Local 'YYYY-MM-DD HH:MM:SS' of every record"""
+        if np is not None:
+            return [text.replace('T', ' ') for text in np.datetime_as_string(self.local.astype('datetime64[s]')).tolist()]
+        return [datetime.utcfromtimestamp(moment).strftime('%Y-%m-%d %H:%M:%S') for moment in self.local]
+
+    def isoformat(self):
+        """ISO 8601 validfrom with UTC offset of every record"""
+        suffixes = {}
+        for offset in set(self.offsets.tolist()):
+            suffixes[offset] = f"{'-' if offset < 0 else '+'}{abs(offset) // 3600:02}:{abs(offset) % 3600 // 60:02}"
+        return [timestamp.replace(' ', 'T') + suffixes[offset] for timestamp, offset in zip(self.timestamps(), self.offsets.tolist())]
+
+    def rows(self, day, hour=None):
+        """(first row, row after the last) of a local date, or of one hour of it"""
+        start, stop = self.dayIndex.get(day, (0, 0))
+        if hour is None or start == stop:
+            return start, stop
+        first = (day.toordinal() - EPOCH_ORDINAL) * 86400 + hour * 3600
+        if np is not None:
+            return start + int(np.searchsorted(self.local[start:stop], first)), start + int(np.searchsorted(self.local[start:stop], first + 3600))
+        return bisect.bisect_left(self.local, first, start, stop), bisect.bisect_left(self.local, first + 3600, start, stop)
+
+    def slice(self, start, stop):
+        """Forecast with the rows from start to stop (views on the columns with NumPy)"""
+        part = Forecast(self.times[start:stop], self.offsets[start:stop], self.capacities[start:stop], self.step)
+        if self.kwh:
+            part.setKwh([kwh[start:stop] for kwh in self.kwh])
+        return part
+
+    def day(self, day, hour=None):
+        """Forecast of one local date, or of one hour of it"""
+        return self.slice(*self.rows(day, hour))
+
+    def resample(self, step):
+        """Forecast at another resolution (seconds per record)
+
+        Longer steps sum the kWh and average the capacity of the records within each step (aligned to the
+        local clock), shorter steps split every record evenly.
+        """
+        if step == self.step or not len(self):
+            return self
+        if step > self.step:
+            if np is not None:
+                bins = self.local // step
+                starts = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+                counts = np.diff(np.concatenate((starts, [len(self)])))
+                times = self.times[starts] - self.local[starts] % step
+                offsets = self.offsets[starts]
+                capacities = np.add.reduceat(self.capacities, starts) / counts
+                kwh = [np.add.reduceat(values, starts) for values in self.kwh]
+            else:
+                starts = [row for row in range(len(self)) if row == 0 or self.local[row] // step != self.local[row - 1] // step]
+                bounds = list(zip(starts, starts[1:] + [len(self)]))
+                times = [self.times[start] - self.local[start] % step for start in starts]
+                offsets = [self.offsets[start] for start in starts]
+                capacities = [sum(self.capacities[start:stop]) / (stop - start) for start, stop in bounds]
+                kwh = [[sum(values[start:stop]) for start, stop in bounds] for values in self.kwh]
+        else:
+            factor = self.step // step
+            if np is not None:
+                times = (self.times[:, None] + np.arange(factor) * step).ravel()
+                offsets = np.repeat(self.offsets, factor)
+                capacities = np.repeat(self.capacities, factor)
+                kwh = [np.repeat(values, factor) / factor for values in self.kwh]
+            else:
+                times = [moment + part * step for moment in self.times for part in range(factor)]
+                offsets = [offset for offset in self.offsets for part in range(factor)]
+                capacities = [capacity for capacity in self.capacities for part in range(factor)]
+                kwh = [[value / factor for value in values for part in range(factor)] for values in self.kwh]
+        resampled = Forecast(times, offsets, capacities, step)
+        if self.kwh:
+            resampled.setKwh(kwh)
+        return resampled
+
+    def setKwh(self, kwh):
+        """Set the corrected kWh per panel array, their sum per record becomes the total"""
+        self.kwh = [column('d', values) for values in kwh]
+        if np is not None:
+            self.total = self.kwh[0] if len(self.kwh) == 1 else np.sum(self.kwh, axis=0)
+            self.cumulative = np.concatenate(([0.0], np.cumsum(self.total)))
+        else:
+            self.total = self.kwh[0] if len(self.kwh) == 1 else array('d', map(sum, zip(*self.kwh)))
+            self.cumulative = [0.0]
+            for value in self.total:
+                self.cumulative.append(self.cumulative[-1] + value)
+
+    def dailyTotal(self, day):
+        """Total kWh of a local date"""
+        start, stop = self.dayIndex.get(day, (0, 0))
+        return float(self.cumulative[stop] - self.cumulative[start]) if stop else 0.0
+
+class ForecastBuilder:
+    """Collects a forecast chunk by chunk, as the records stream in, into one Forecast"""
+
+    def __init__(self):
+        self.parts = []
+
+    def add(self, chunk):
+        """Append a Forecast chunk, with or without kWh"""
+        if len(chunk):
+            self.parts.append(chunk)
+
+    def build(self):
+        """The Forecast of all chunks, with the kWh per panel array when every chunk has them"""
+        if not self.parts:
+            return Forecast([], [], [], 3600)
+        step = self.parts[0].step
+        if len(self.parts) == 1:
+            return self.parts[0]
+        corrected = all(part.kwh for part in self.parts)
+        columns = [[part.times for part in self.parts], [part.offsets for part in self.parts], [part.capacities for part in self.parts]]
+        if corrected:
+            columns += [[part.kwh[index] for part in self.parts] for index in range(len(self.parts[0].kwh))]
+        if np is not None:
+            columns = [np.concatenate(values) for values in columns]
+        else:
+            columns = [[value for values in parts for value in values] for parts in columns]
+        times, offsets, capacities, *kwh = sortColumns(*columns)
+        forecast = Forecast(times, offsets, capacities, step)
+        if corrected:
+            forecast.setKwh(kwh)
+        return forecast
@@ -0,0 +1,138 @@
+#
+#   Persistent forecast cache for the NED solar forecast plugin
+#
+#   Author: Jan-Jaap Kostelijk
+#
+#   Stores NED forecasts in a small SQLite database in the plugin folder,
+#   keyed by the request parameters (point, type, classification, granularity
+#   and date range). A connection is opened per call so the cache can be used
+#   from the fetch worker thread as well as from the Domoticz plugin thread.
+#
+#   The database lives in the plugin folder, which all instances of the plugin
+#   on a host share. They read it concurrently (WAL journal, memory mapped) and
+#   take a file lock per request around a fetch, so when several instances need
+#   the same forecast one of them calls the NED API and the others wait for it
+#   and read the stored forecast. Every request key has its own lock file,
+#   removed after the fetch, so unrelated requests never wait for each other.
+#
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # no file locks (Windows), every instance fetches for itself
+
+class ForecastCache:
+    """NED forecasts stored on disk, keyed by the request parameters"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lockFolder = path + ".locks"
+        with self.connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS forecast (
+                point TEXT NOT NULL,
+                type INTEGER NOT NULL,
+                classification INTEGER NOT NULL,
+                granularity INTEGER NOT NULL,
+                validfrom TEXT NOT NULL,
+                validto TEXT NOT NULL,
+                fetched REAL NOT NULL,
+                payload TEXT NOT NULL,
+                PRIMARY KEY (point, type, classification, granularity, validfrom, validto))""")
+
+    @contextlib.contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=10)
+        db.execute("PRAGMA mmap_size=8388608")
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    @staticmethod
+    def key(params):
+        return (str(params['point']), int(params['type']), int(params['classification']), int(params['granularity']),
+                str(params['validfrom[after]']), str(params['validfrom[strictly_before]']))
+
+    @contextlib.contextmanager
+    def fetchLock(self, params, timeout=120, poll=0.1, cancel=None):
+        """Hold the host wide lock for fetching these request parameters, yields False when it could not be taken
+
+        Gives up after timeout seconds or when cancel (a threading.Event) is set. Look the forecast up again
+        once the lock is held: another instance may just have stored it.
+        """
+        if fcntl is None:
+            yield False
+            return
+        path = os.path.join(self.lockFolder, hashlib.sha1(repr(self.key(params)).encode()).hexdigest() + ".lock")
+        try:
+            os.makedirs(self.lockFolder, exist_ok=True)
+        except OSError:
+            yield False
+            return
+        deadline = time.monotonic() + timeout
+        lockFile = None
+        try:
+            while lockFile is None:
+                try:
+                    candidate = open(path, 'a')
+                except OSError:
+                    break
+                try:
+                    fcntl.flock(candidate, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    # the previous holder removes the file when it is done, only a lock on the file still at path counts
+                    if os.path.samestat(os.fstat(candidate.fileno()), os.stat(path)):
+                        lockFile = candidate
+                        continue
+                except (BlockingIOError, FileNotFoundError):
+                    pass
+                candidate.close()
+                if time.monotonic() >= deadline or (cancel.wait(poll) if cancel is not None else time.sleep(poll)):
+                    break
+            yield lockFile is not None
+        finally:
+            if lockFile is not None:
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+                lockFile.close()
+
+    def put(self, params, data, fetched=None):
+        """Store a forecast for the given request parameters"""
+        if fetched is None:
+            fetched = time.time()
+        with self.connect() as db:
+            db.execute("INSERT OR REPLACE INTO forecast VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       self.key(params) + (fetched, json.dumps(data, separators=(',', ':'))))
+
+    def lookup(self, params):
+        """Return (age in seconds, data) for exactly these request parameters, or None"""
+        with self.connect() as db:
+            row = db.execute("""SELECT fetched, payload FROM forecast WHERE point = ? AND type = ? AND classification = ?
+                                AND granularity = ? AND validfrom = ? AND validto = ?""", self.key(params)).fetchone()
+        if row is None:
+            return None
+        return time.time() - row[0], json.loads(row[1])
+
+    def latest(self, params):
+        """Return (age in seconds, data) of the most recent forecast for the same point and series, or None
+
+        Used as fallback when the NED API is unreachable and the requested date range is not cached.
+        """
+        with self.connect() as db:
+            row = db.execute("""SELECT fetched, payload FROM forecast WHERE point = ? AND type = ? AND classification = ?
+                                AND granularity = ? ORDER BY validfrom DESC, fetched DESC LIMIT 1""", self.key(params)[:4]).fetchone()
+        if row is None:
+            return None
+        return time.time() - row[0], json.loads(row[1])
+
+    def purge(self, max_age):
+        """Remove forecasts fetched more than max_age seconds ago"""
+        with self.connect() as db:
+            db.execute("DELETE FROM forecast WHERE fetched < ?", (time.time() - max_age,))
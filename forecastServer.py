@@ -0,0 +1,76 @@
+#
+#   Forecast server for the NED solar forecast plugin
+#
+#   Author: Jan-Jaap Kostelijk
+#
+#   Small read-only HTTP/JSON endpoint so other systems (battery scheduler,
+#   Grafana, Node-RED, ...) can use the corrected forecast without calling the
+#   NED API themselves. Documents are serialized once when they are published,
+#   requests only look up the bytes. Every document has an ETag, a client that
+#   sends it back in If-None-Match gets an empty 304 until the forecast changes.
+#
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class ForecastServer:
+    """Serves published JSON documents by path on a background thread"""
+
+    def __init__(self, port, host='127.0.0.1', log=None):
+        self.port = port
+        self.host = host
+        self.log = log
+        self.documents = {}  # path -> (ETag, body), replaced as a whole on publish
+        self.server = None
+
+    def publish(self, path, document):
+        """Serialize document and serve it on path"""
+        body = json.dumps(document, separators=(',', ':')).encode()
+        self.documents[path] = (f'"{hashlib.sha1(body).hexdigest()}"', body)
+
+    def respond(self, path, etags):
+        """Return (status, headers, body) for a GET of path, etags is the If-None-Match header"""
+        document = self.documents.get(path.split('?', 1)[0].rstrip('/') or '/')
+        if document is None:
+            return 404, {'Content-Type': 'application/json'}, b'{"error":"not found"}'
+        etag, body = document
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Content-Type': 'application/json'}
+        if etags and (etags.strip() == '*' or etag in etags):
+            return 304, headers, b''
+        return 200, headers, body
+
+    def start(self):
+        """Start serving, raises OSError when the port is not available"""
+        forecastServer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self, head=False):
+                status, headers, body = forecastServer.respond(self.path, self.headers.get('If-None-Match'))
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if not head:
+                    self.wfile.write(body)
+
+            def do_HEAD(self):
+                self.do_GET(head=True)
+
+            def log_message(self, format, *args):
+                if forecastServer.log:
+                    forecastServer.log(f"Forecast server: {self.address_string()} {format % args}")
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(name="NEDserver", target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
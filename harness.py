@@ -0,0 +1,60 @@
+#
+#   Local test harness for the NED solar forecast plugin
+#
+#   Author: Jan-Jaap Kostelijk
+#
+#   Runs the plugin against fakeDomoticz and a slow local NED stand-in (fakeNED)
+#   and reports how long loading the plugin and the Domoticz callbacks take and
+#   after how long the first forecast is shown. Usage:
+#       python harness.py [--delay seconds] [--heartbeats n] [--locations codes] [--port n] [--home folder]
+#
+import argparse
+import tempfile
+import time
+
+from fakeNED import FakeNED
+
+def timed(callback):
+    start = time.perf_counter()
+    callback()
+    return (time.perf_counter() - start) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the plugin against fakeDomoticz with a slow NED API stand-in")
+    parser.add_argument('--delay', type=float, default=5.0, help="seconds the NED stand-in takes to answer")
+    parser.add_argument('--errors', type=float, default=0.0, help="fraction of NED requests answered with an error")
+    parser.add_argument('--heartbeats', type=int, default=10, help="number of heartbeats to run")
+    parser.add_argument('--interval', type=float, default=1.0, help="seconds between heartbeats")
+    parser.add_argument('--locations', default="", help="extra locations (Address parameter), e.g. 1,7,10")
+    parser.add_argument('--port', default="", help="forecast server port (Port parameter, default: off)")
+    parser.add_argument('--home', default=None, help="plugin HomeFolder, reuse it to start from a filled cache (default: new temporary folder)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    import plugin
+    import fakeDomoticz
+    print(f"import plugin took {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    fake = FakeNED(latency=args.delay, errors=args.errors)
+    plugin.SolarForecastPlug.apiUrl = fake.start()
+    plugin.Parameters['Mode5'] = "harness"
+    plugin.Parameters['Address'] = args.locations
+    plugin.Parameters['Port'] = args.port
+    plugin.Parameters['HomeFolder'] = args.home or (tempfile.mkdtemp(prefix="NEDsolarForecast-") + "/")
+    print(f"HomeFolder: {plugin.Parameters['HomeFolder']}")
+
+    started = time.perf_counter()
+    print(f"onStart took {timed(plugin.onStart):.1f} ms")
+    shown = False
+    for beat in range(args.heartbeats):
+        time.sleep(args.interval)
+        print(f"heartbeat {beat + 1} took {timed(plugin.onHeartbeat):.1f} ms (fetch pending: {plugin._plugin.fetchWorker.busy()})")
+        if not shown and plugin._plugin.forecasts:
+            shown = True
+            print(f"first forecast shown {(time.perf_counter() - started) * 1000:.0f} ms after onStart was called ({fakeDomoticz.updateCount()} unit updates)")
+    print(f"onStop took {timed(plugin.onStop):.1f} ms")
+    print(f"NED stand-in answered {fake.requests} requests")
+    fake.stop()
+
+if __name__ == "__main__":
+    main()
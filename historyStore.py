@@ -0,0 +1,82 @@
+#
+#   Historical utilization store for the NED solar forecast plugin
+#
+#   Author: Jan-Jaap Kostelijk
+#
+#   Keeps past NED forecasts and actuals in a compact SQLite table, one row per
+#   point, classification, granularity and moment (epoch seconds). The primary
+#   key doubles as the timestamp index (WITHOUT ROWID, so the rows are stored in
+#   key order) which makes range queries a single index scan. Backfilled date
+#   ranges are recorded as chunks in the same transaction as their records, so
+#   an interrupted backfill resumes where it stopped.
+#
+import contextlib
+import sqlite3
+from datetime import datetime
+
+class HistoryStore:
+    """Utilization records by point, classification and time, with the backfilled chunks"""
+
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS utilization (
+                point INTEGER NOT NULL,
+                classification INTEGER NOT NULL,
+                granularity INTEGER NOT NULL,
+                validfrom INTEGER NOT NULL,
+                capacity REAL,
+                volume REAL,
+                percentage REAL,
+                PRIMARY KEY (point, classification, granularity, validfrom)) WITHOUT ROWID""")
+            db.execute("""CREATE TABLE IF NOT EXISTS chunk (
+                point INTEGER NOT NULL,
+                classification INTEGER NOT NULL,
+                granularity INTEGER NOT NULL,
+                start TEXT NOT NULL,
+                end TEXT NOT NULL,
+                records INTEGER NOT NULL,
+                PRIMARY KEY (point, classification, granularity, start, end)) WITHOUT ROWID""")
+
+    @contextlib.contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    @staticmethod
+    def rows(point, classification, granularity, records):
+        for record in records:
+            yield (int(point), int(classification), int(granularity), int(datetime.fromisoformat(record['validfrom']).timestamp()),
+                   record.get('capacity'), record.get('volume'), record.get('percentage'))
+
+    def put(self, point, classification, granularity, start, end, records, final=True):
+        """Store the records of one backfilled chunk (start and end are ISO dates), marking the chunk as done when it is final"""
+        with self.connect() as db:
+            db.executemany("INSERT OR REPLACE INTO utilization VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           self.rows(point, classification, granularity, records))
+            if final:
+                db.execute("INSERT OR REPLACE INTO chunk VALUES (?, ?, ?, ?, ?, ?)",
+                           (int(point), int(classification), int(granularity), str(start), str(end), len(records)))
+
+    def done(self, granularity):
+        """Set of (point, classification, start, end) chunks already backfilled at this granularity"""
+        with self.connect() as db:
+            return {(str(point), classification, start, end) for point, classification, start, end in
+                    db.execute("SELECT point, classification, start, end FROM chunk WHERE granularity = ?", (int(granularity),))}
+
+    def query(self, point, classification, start, end, granularity=5):
+        """List of (validfrom epoch, capacity, volume, percentage) from start (inclusive) to end (exclusive), both epoch seconds"""
+        with self.connect() as db:
+            return db.execute("""SELECT validfrom, capacity, volume, percentage FROM utilization
+                                 WHERE point = ? AND classification = ? AND granularity = ? AND validfrom >= ? AND validfrom < ?
+                                 ORDER BY validfrom""",
+                              (int(point), int(classification), int(granularity), int(start), int(end))).fetchall()
+
+    def count(self):
+        with self.connect() as db:
+            return db.execute("SELECT COUNT(*) FROM utilization").fetchone()[0]
@@ -0,0 +1,36 @@
+#
+#   Lazy imports for the NED solar forecast plugin
+#
+#   Author: Jan-Jaap Kostelijk
+#
+#   Heavy modules (numpy, requests) take most of the time of loading the
+#   plugin. They are imported on first use instead, which happens on the fetch
+#   worker thread, so loading the plugin and onStart stay fast on slow hosts.
+#
+import importlib
+import importlib.util
+import sys
+
+class LazyModule:
+    """Stand-in for a module, imports it on first attribute access"""
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+
+    def __getattr__(self, attribute):
+        # only called for attributes not copied yet: import and take over the module namespace
+        module = importlib.import_module(self._name)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attribute)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'>"
+
+def lazyImport(name):
+    """The module when it is already loaded, a LazyModule when it is installed, otherwise None"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    if importlib.util.find_spec(name) is None:
+        return None
+    return LazyModule(name)
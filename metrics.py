@@ -0,0 +1,80 @@
+#
+#   Instrumentation for the NED solar forecast plugin
+#
+#   Author: Jan-Jaap Kostelijk
+#
+#   Keeps rolling latency samples per pipeline stage (HTTP round trip, JSON
+#   decoding, solar correction, device writes, ...) and event counters. Stages
+#   are recorded from the fetch worker threads as well as from the heartbeat,
+#   so all access is guarded by a lock.
+#
+import contextlib
+import threading
+import time
+from collections import deque, Counter
+
+class Metrics:
+    """Rolling stage latencies (ms) and counters"""
+
+    def __init__(self, window=100):
+        self.window = window
+        self.samples = {}
+        self.counters = Counter()
+        self.lastSuccess = None
+        self.lock = threading.Lock()
+
+    def record(self, stage, ms):
+        with self.lock:
+            if stage not in self.samples:
+                self.samples[stage] = deque(maxlen=self.window)
+            self.samples[stage].append(ms)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Time the enclosed block as one sample of stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, (time.perf_counter() - start) * 1000)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def counter(self, name):
+        with self.lock:
+            return self.counters[name]
+
+    def success(self):
+        """Mark a successful poll"""
+        with self.lock:
+            self.lastSuccess = time.time()
+
+    def successAge(self):
+        """Seconds since the last successful poll, or None"""
+        with self.lock:
+            if self.lastSuccess is None:
+                return None
+            return time.time() - self.lastSuccess
+
+    def percentile(self, stage, pct):
+        """Nearest-rank percentile of the stage samples in ms, or None without samples"""
+        with self.lock:
+            samples = sorted(self.samples.get(stage, ()))
+        if not samples:
+            return None
+        rank = max(1, -(-len(samples) * pct // 100))
+        return samples[int(rank) - 1]
+
+    def summary(self):
+        """One line per stage with sample count and p50/p90/p99, followed by the counters"""
+        with self.lock:
+            stages = sorted(self.samples)
+            counters = dict(self.counters)
+        lines = []
+        for stage in stages:
+            p50, p90, p99 = (self.percentile(stage, pct) for pct in (50, 90, 99))
+            lines.append(f"{stage}: n={len(self.samples[stage])} p50={p50:.1f} ms p90={p90:.1f} ms p99={p99:.1f} ms")
+        lines.append("counters: " + ", ".join(f"{name}={value}" for name, value in sorted(counters.items())))
+        return lines
@@ -0,0 +1,223 @@
+#
+#   NED API client for the NED solar forecast plugin
+#
+#   Author: Jan-Jaap Kostelijk
+#
+#   Keeps one pooled requests.Session (keep-alive) per plugin instance, retries
+#   5xx and 429 responses with exponential backoff and jitter (honouring
+#   Retry-After) and spaces requests with a token bucket so we stay inside the
+#   per-key request limit of the NED API. The bucket can be kept in a file, so
+#   all plugin instances and backfill runs on a host share the limit. Paged
+#   responses are streamed record by record while the next page is already
+#   being fetched.
+#
+import contextlib
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+from lazyModule import LazyModule
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # no file locks (Windows), the request limit is kept per process
+
+requests = LazyModule('requests')  # imported when the first client is created
+
+class TokenBucket:
+    """Thread safe token bucket, rate tokens per second with a burst of capacity tokens"""
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.values = {'tokens': capacity, 'updated': self.clock(), 'holdUntil': 0.0}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def state(self):
+        """Yield the bucket state (tokens, updated, holdUntil) for exclusive use"""
+        with self.lock:
+            yield self.values
+
+    def hold(self, seconds):
+        """Hand out no tokens for the given number of seconds (used when the server asks us to back off)"""
+        with self.state() as values:
+            values['holdUntil'] = max(values['holdUntil'], self.clock() + seconds)
+
+    def take(self):
+        """Take one token when available, returns 0 or the seconds to wait for the next one"""
+        with self.state() as values:
+            now = self.clock()
+            values['tokens'] = min(self.capacity, values['tokens'] + max(0.0, now - values['updated']) * self.rate)
+            values['updated'] = now
+            if now >= values['holdUntil'] and values['tokens'] >= 1:
+                values['tokens'] -= 1
+                return 0.0
+            return max(values['holdUntil'] - now, (1 - values['tokens']) / self.rate)
+
+    def acquire(self, cancel):
+        """Take one token, waiting when needed. Returns False when cancel (a threading.Event) is set while waiting"""
+        while True:
+            wait = self.take()
+            if not wait:
+                return True
+            if cancel.wait(wait):
+                return False
+
+class SharedTokenBucket(TokenBucket):
+    """Token bucket kept in a file, so all processes using the same path share one request limit"""
+    clock = staticmethod(time.time)  # the monotonic clock is not comparable between processes
+
+    def __init__(self, path, rate, capacity):
+        super().__init__(rate, capacity)
+        self.path = path
+
+    @contextlib.contextmanager
+    def state(self):
+        with self.lock:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                stateFile = open(self.path, 'a+')
+            except OSError:
+                # the folder is not writable: at least keep to the limit within this process
+                yield self.values
+                return
+            with stateFile:
+                fcntl.flock(stateFile, fcntl.LOCK_EX)
+                stateFile.seek(0)
+                try:
+                    values = dict(self.values, **json.loads(stateFile.read() or '{}'))
+                except ValueError:
+                    values = dict(self.values)
+                yield values
+                self.values = values
+                stateFile.truncate(0)
+                stateFile.write(json.dumps(values))
+                stateFile.flush()
+
+def retryAfter(response):
+    """Seconds to wait according to the Retry-After header, or None"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+class NedClient:
+    """Pooled, rate limited and retrying access to the NED API"""
+    baseUrl = "https://api.ned.nl/v1/utilizations"
+
+    def __init__(self, APIkey, timeout=(10, 30), retries=4, backoff=2.0, maxBackoff=300, rate=200 / 300, burst=10, log=None, metrics=None, url=None, bucketPath=None):
+        self.baseUrl = url or self.baseUrl
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.log = log
+        self.metrics = metrics
+        # with a bucketPath every client (plugin instance, backfill) using that file shares the limit of the API key
+        self.bucket = SharedTokenBucket(bucketPath, rate, burst) if bucketPath and fcntl is not None else TokenBucket(rate, burst)
+        self.stopping = threading.Event()
+        self.session = requests.Session()
+        self.session.headers.update({
+            'X-AUTH-TOKEN': APIkey,
+            'accept': 'application/json'
+        })
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def delay(self, attempt):
+        """Exponential backoff with full jitter"""
+        return random.uniform(0, min(self.maxBackoff, self.backoff * 2 ** attempt))
+
+    def get(self, params, url=None):
+        """GET the NED API and return the response, raises a requests exception when all attempts fail"""
+        url = url or self.baseUrl
+        attempt = 0
+        while True:
+            if self.stopping.is_set() or not self.bucket.acquire(self.stopping):
+                raise requests.exceptions.ConnectionError("NED client is stopping")
+            wait = None
+            try:
+                start = time.perf_counter()
+                try:
+                    response = self.session.get(url, params=params, timeout=self.timeout)
+                finally:
+                    if self.metrics:
+                        self.metrics.record('http', (time.perf_counter() - start) * 1000)
+                        self.metrics.count('requests')
+                if response.status_code == 429 or response.status_code >= 500:
+                    wait = retryAfter(response)
+                    if response.status_code == 429 and wait is not None:
+                        self.bucket.hold(wait)
+                response.raise_for_status()
+                return response
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError) as e:
+                if isinstance(e, requests.exceptions.HTTPError) and e.response is not None \
+                        and e.response.status_code != 429 and e.response.status_code < 500:
+                    raise
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                if self.metrics:
+                    self.metrics.count('retries')
+                if wait is None:
+                    wait = self.delay(attempt)
+                elif wait > self.maxBackoff:
+                    raise  # server asks for a longer pause than we are willing to wait, the token bucket keeps honouring it
+                if self.log:
+                    self.log(f"NED API request failed ({str(e)}), retry {attempt}/{self.retries} in {wait:.1f} s")
+                if self.stopping.wait(wait):
+                    raise
+
+    def page(self, params, page, itemsPerPage):
+        """Fetch one page, returns (records, more pages available), more is None when the payload does not tell (a plain list)"""
+        response = self.get(dict(params, page=page, itemsPerPage=itemsPerPage))
+        start = time.perf_counter()
+        payload = response.json()
+        if self.metrics:
+            self.metrics.record('decode', (time.perf_counter() - start) * 1000)
+        if isinstance(payload, dict):
+            # JSON-LD (hydra) collection
+            return payload.get('hydra:member', []), 'hydra:next' in payload.get('hydra:view', {})
+        if not isinstance(payload, list):
+            raise ValueError("Unexpected data format from NED API")
+        return payload, None
+
+    def records(self, params, itemsPerPage=200):
+        """Yield the records of all pages, the next page is fetched while the current one is consumed
+
+        The server may return fewer records per page than asked for, so for a plain list the length of the first
+        page is the page size: paging continues until a page is shorter than that, or empty.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="NEDpage") as prefetch:
+            page = 1
+            pageSize = None
+            future = prefetch.submit(self.page, params, page, itemsPerPage)
+            while future is not None:
+                records, more = future.result()
+                if more is None:
+                    pageSize = pageSize or len(records)
+                    more = 0 < len(records) >= pageSize
+                page += 1
+                future = prefetch.submit(self.page, params, page, itemsPerPage) if more else None
+                yield from records
+
+    def close(self):
+        """Abort waiting requests and release the pooled connections"""
+        self.stopping.set()
+        self.session.close()
@@ -9,17 +9,26 @@
         Fetches solar power forecast from the site solar.forecast<br/><br/><br/>
     </description>
     <params>
-		<param field="Mode1" label="Panels declination" width="30px" required="true" default="45">
-            <description>Angle of the solar panels to earth surface: 0 (horizontal) … 90 (vertical)</description>
+		<param field="Mode1" label="Panels declination" width="100px" required="true" default="45">
+            <description>Angle of the solar panels to earth surface: 0 (horizontal) … 90 (vertical). Separate the values of multiple arrays with ';'</description>
         </param>
-		<param field="Mode2" label="Panels azimuth" width="30px" required="true" default="0">
-            <description>Angle of the solar panels to earth compass: -180 … 180 (-180 = north, -90 = east, 0 = south, 90 = west, 180 = north)</description>
+		<param field="Mode2" label="Panels azimuth" width="100px" required="true" default="0">
+            <description>Angle of the solar panels to earth compass: -180 … 180 (-180 = north, -90 = east, 0 = south, 90 = west, 180 = north). Separate the values of multiple arrays with ';'</description>
         </param>
-		<param field="Mode3" label="Panels peak power" width="30px" required="true" default="4.8">
-            <description>Installed power of the modules in kilo Watt [kW]</description>
+		<param field="Mode3" label="Panels peak power" width="100px" required="true" default="4.8">
+            <description>Installed power of the modules in kilo Watt [kW]. Separate the values of multiple arrays with ';'</description>
         </param>
 		<param field="Mode5" label="API key" width="200px" required="true">
             <description>Your personal NED API key - obtain from https://ned.nl/user</description>
+        </param>
+		<param field="Address" label="Extra locations" width="200px" required="false" default="">
+            <description>Optional: more locations to forecast, as codes or names separated by ',' (e.g. 7,Utrecht). Each location gets its own device</description>
+        </param>
+		<param field="Username" label="Options" width="200px" required="false" default="">
+            <description>Optional settings as key=value pairs separated by ';'. ttl: minutes a cached forecast stays fresh (default 180), granularity: 60 or 15 minutes per forecast record (default 60), bind: address the forecast server listens on (default 127.0.0.1, this host only; 0.0.0.0 for the whole network)</description>
+        </param>
+		<param field="Port" label="Forecast server port" width="75px" required="false" default="">
+            <description>Optional: serve the corrected forecast as JSON on this port (e.g. http://127.0.0.1:port/forecast/6, only reachable from this host unless the bind option is set), leave empty to disable</description>
         </param>
 		<param field="Mode4" label="Debug" width="75px">
             <options>
@@ -49,6 +58,9 @@
     </params>
 </plugin>
 """
+import time
+importStart = time.perf_counter()
+
 try:
 	import DomoticzEx as Domoticz
 	debug = False
@@ -58,19 +70,53 @@ except ImportError:
     Domoticz = Domoticz()
     debug = True
 
-import json
-import time
-import requests
-import math
+import contextlib
+import os
+import sqlite3
+import threading
 from datetime import datetime, timedelta, date
 
+from fetchWorker import FetchWorker
+from forecast import Forecast, ForecastBuilder
+from forecastCache import ForecastCache
+from lazyModule import LazyModule
+from nedClient import NedClient
+from metrics import Metrics
+from scheduler import PollScheduler
+import solarGeometry
+
+requests = LazyModule('requests')  # only needed once the first fetch runs on the worker thread
+
 class SolarForecastPlug:
     #define class variables
     location_code = '0'
-    doneForToday = False
+    location_codes = ['0']
+    maxWorkers = 4  # maximum number of concurrent NED API requests
+    itemsPerPage = 200  # page size requested from the NED API
+    correctionChunk = 256  # records parsed and corrected per batch in the processing pipeline
+    healthInterval = 300  # seconds between updates of the health device
+    lastHealthUpdate = 0
+    profileRequested = False
+
+    # Units of the health device
+    healthUnits = {
+        1: {'Name': 'fetch latency p50', 'TypeName': 'Custom', 'Options': {'Custom': '1;ms'}},
+        2: {'Name': 'fetch latency p90', 'TypeName': 'Custom', 'Options': {'Custom': '1;ms'}},
+        3: {'Name': 'last successful poll', 'TypeName': 'Custom', 'Options': {'Custom': '1;min'}},
+        4: {'Name': 'API errors', 'TypeName': 'Custom', 'Options': {'Custom': '1;errors'}},
+        5: {'Name': 'profile next poll', 'Type': 244, 'Subtype': 73, 'Switchtype': 9}
+    }
     debug = False
     APIkey = ""
-    last_api_call = None
+    apiUrl = NedClient.baseUrl
+    timeout = (10, 30)  # connect / read timeout in seconds for NED API calls
+    cacheTTL = 180 * 60  # seconds a cached forecast is served without calling the NED API, also the refresh interval
+    granularity = 60  # minutes per forecast record requested from the NED API
+    granularityCodes = {15: 4, 60: 5}  # minutes -> NED granularity
+    forecastCache = None
+    nedClient = None
+    forecastServer = None
+    stopped = False  # set by onStop, jobs still queued are skipped and no new NED client is created
     
     # Location names for Netherlands provinces
     locations = {
@@ -90,10 +136,18 @@ class SolarForecastPlug:
     }
 
     def __init__(self):
-        pass
+        self.fetchWorker = FetchWorker(self.fetchJob)
+        self.clientLock = threading.Lock()
+        self.sunTable = solarGeometry.SunTable(self.locations)
+        self.lastWritten = {}  # (DeviceID, Unit) -> {timestamp: sValue} as last written to Domoticz
+        self.forecasts = {}  # location code -> latest corrected Forecast at the requested granularity
+        self.published = {}  # location code -> moment the forecast was published on the forecast server
+        self.metrics = Metrics()
+        self.schedulers = {}  # location code -> PollScheduler
 
     def onStart(self):
         Domoticz.Log("onStart called")
+        start = time.perf_counter()
         if Parameters['Mode4'] == 'Debug' or self.debug == True:
             Domoticz.Debugging(2)
             DumpConfigToLog()
@@ -104,73 +158,201 @@ class SolarForecastPlug:
 
         #read out parameters
         self.location_code = Parameters['Mode6']
-        Domoticz.Debug(f"Using location: {self.locations[self.location_code]['name']} (code: {self.location_code})")
-        self.dec = int(Parameters['Mode1'])
-        self.az = int(Parameters['Mode2'])
-        self.kwp = float(Parameters['Mode3'])
+        self.location_codes = [self.location_code] + [code for code in parseLocations(Parameters.get('Address', ''), self.locations) if code != self.location_code]
+        for location_code in self.location_codes:
+            Domoticz.Debug(f"Using location: {self.locations[location_code]['name']} (code: {location_code})")
+        self.arrays = parseArrays(Parameters['Mode1'], Parameters['Mode2'], Parameters['Mode3'])
+        for number, array in enumerate(self.arrays, 1):
+            Domoticz.Debug(f"Panel array {number}: declination {array['dec']}, azimuth {array['az']}, {array['kwp']} kWp")
+        self.dec = self.arrays[0]['dec']
+        self.az = self.arrays[0]['az']
+        self.kwp = self.arrays[0]['kwp']
         self.APIkey = Parameters['Mode5']
         if len(self.APIkey) == 0:
             Domoticz.Error("API key is required to use the NED API")
+        self.sunTable.path = os.path.join(Parameters['HomeFolder'], 'suntable.npz')
+        options = parseOptions(Parameters.get('Username', ''))
+        try:
+            self.cacheTTL = int(options.get('ttl', self.cacheTTL // 60)) * 60
+        except ValueError:
+            Domoticz.Error(f"Invalid ttl option '{options['ttl']}', using {self.cacheTTL // 60} minutes")
+        granularity = options.get('granularity', str(self.granularity))
+        if granularity.isdigit() and int(granularity) in self.granularityCodes:
+            self.granularity = int(granularity)
+        else:
+            Domoticz.Error(f"Invalid granularity option '{granularity}', use 15 or 60 minutes, using {self.granularity} minutes")
+        self.schedulers = {location_code: PollScheduler(refresh=self.cacheTTL) for location_code in self.location_codes}
+        try:
+            self.forecastCache = ForecastCache(os.path.join(Parameters['HomeFolder'], 'forecastcache.db'))
+        except sqlite3.Error as e:
+            Domoticz.Error(f"Forecast cache not available: {str(e)}")
 
         self.deviceId = "SolarForecast"
         self.deviceId = Parameters['Name']
-        Domoticz.Device(DeviceID=self.deviceId) 
-        if self.deviceId not in Devices or (1 not in Devices[self.deviceId].Units):
-            #Options={"AddDBLogEntry" : "true", "DisableLogAutoUpdate" : "true"}
-            #Options={"AddDBLogEntry" : "true"}
-            #Domoticz.Unit(Name=self.deviceId + ' - 24h forecast', Unit=1, Type=243, Subtype=33, Switchtype=4,  Used=1, Options=Options, DeviceID=self.deviceId).Create()
-            Domoticz.Unit(Name=self.deviceId + ' - 24h forecast', Unit=1, Type=243, Subtype=33, Switchtype=4,  Used=1, DeviceID=self.deviceId).Create()
+        # one device per location, the main location keeps the plain plugin name as DeviceID
+        self.deviceIds = {}
+        for location_code in self.location_codes:
+            deviceId = self.deviceId
+            if location_code != self.location_code:
+                deviceId = f"{self.deviceId} {self.locations[location_code]['name']}"
+            self.deviceIds[location_code] = deviceId
+            Domoticz.Device(DeviceID=deviceId) 
+            if deviceId not in Devices or (1 not in Devices[deviceId].Units):
+                #Options={"AddDBLogEntry" : "true", "DisableLogAutoUpdate" : "true"}
+                #Options={"AddDBLogEntry" : "true"}
+                #Domoticz.Unit(Name=deviceId + ' - 24h forecast', Unit=1, Type=243, Subtype=33, Switchtype=4,  Used=1, Options=Options, DeviceID=deviceId).Create()
+                Domoticz.Unit(Name=deviceId + ' - 24h forecast', Unit=1, Type=243, Subtype=33, Switchtype=4,  Used=1, DeviceID=deviceId).Create()
+            # with multiple panel arrays unit 1 holds the combined forecast and unit 2 and up the forecast per array
+            if len(self.arrays) > 1:
+                for number, array in enumerate(self.arrays, 1):
+                    if number + 1 not in Devices[deviceId].Units:
+                        Domoticz.Unit(Name=f"{deviceId} - array {number} ({array['az']}°) 24h forecast", Unit=number + 1, Type=243, Subtype=33, Switchtype=4,  Used=1, DeviceID=deviceId).Create()
+
+        # optional JSON endpoint with the corrected forecasts
+        port = str(Parameters.get('Port', '')).strip()
+        if port and port != '0':
+            try:
+                from forecastServer import ForecastServer
+                self.forecastServer = ForecastServer(int(port), options.get('bind', '127.0.0.1'), log=Domoticz.Debug)
+                self.forecastServer.start()
+                self.publishIndex()
+                Domoticz.Log(f"Serving the forecast on port {port}")
+            except (ValueError, OSError) as e:
+                Domoticz.Error(f"Forecast server not started on port '{port}': {str(e)}")
+                self.forecastServer = None
+
+        # health device showing the plugin's own metrics
+        self.healthId = f"{self.deviceId} health"
+        Domoticz.Device(DeviceID=self.healthId)
+        for unit, definition in self.healthUnits.items():
+            if self.healthId not in Devices or (unit not in Devices[self.healthId].Units):
+                Domoticz.Unit(Unit=unit, Used=1, DeviceID=self.healthId, **dict(definition, Name=f"{self.healthId} - {definition['Name']}")).Create()
             
-        data = self.getData(self.location_code)
-        if data:
-            self.updateDevices(data)
-        self.doneForToday = False
+        # the first forecast comes from the cache, read on the worker thread and shown on the next heartbeat,
+        # followed by a fetch from the NED API when the cached one is missing or stale. All cache reads are queued
+        # before the fetches, so with more locations than workers no cached forecast waits behind a slow fetch
+        self.fetchWorker.workers = min(self.maxWorkers, len(self.location_codes))
+        self.fetchWorker.start()
+        for location_code in self.location_codes:
+            self.fetchWorker.request('cache', location_code)
+        for location_code in self.location_codes:
+            self.fetchWorker.request('fetch', location_code)
+        self.metrics.record('import', importTime)
+        self.metrics.record('onStart', (time.perf_counter() - start) * 1000)
+        Domoticz.Debug(f"onStart took {(time.perf_counter() - start) * 1000:.1f} ms (plugin import {importTime:.1f} ms)")
 
     def onStop(self):
         Domoticz.Debug("onStop called")
+        with self.clientLock:
+            self.stopped = True
+            if self.nedClient is not None:
+                self.nedClient.close()
+        if self.forecastServer is not None:
+            self.forecastServer.stop()
+        # closing the client aborts waits and retries, a request in flight ends within its connect + read timeout
+        if not self.fetchWorker.stop(timeout=sum(self.timeout) + 5):
+            Domoticz.Error("Fetch worker did not stop in time")
 
     def onCommand(self, DeviceId, Unit, Command, Level, Hue):
         Domoticz.Debug("onCommand: DeviceId: '"+str(DeviceId)+"' Unit: '"+str(Unit)+"', Command: '"+str(Command)+"', Level: '"+str(Level)+"', Hue: '"+str(Hue)+"'")
+        if DeviceId == self.healthId and Unit == 5:
+            if self.debug:
+                Domoticz.Log("Profiling the next poll cycle")
+                self.profileRequested = True
+            else:
+                Domoticz.Log("Profiling is only available with debug logging enabled")
 
     def onHeartbeat(self):
         #Domoticz.Debug("onHeartbeat called")
-        current_hour = datetime.now().hour
-        current_time = datetime.now()
-        should_poll = False
-        
-        # Check if we should poll the API
-        if (current_hour == 22 or current_hour == 23):
-            # Normal polling hours: once per day
-            if not self.doneForToday:
-                should_poll = True
-                self.doneForToday = True
-        elif self.debug:
-            # Debug mode: maximum once per minute
-            if self.last_api_call is None or (current_time - self.last_api_call).total_seconds() >= 60:
-                should_poll = True
-                self.last_api_call = current_time
-        
-        # Reset the flag when we're outside the polling hours
-        if current_hour == 21:
-            self.doneForToday = False
-        
-        # Execute the poll if conditions are met
-        if should_poll:
-            data = self.getData(self.location_code)
+        if self.profileRequested:
+            self.profileRequested = False
+            if self.fetchWorker.request('profile', None):
+                Domoticz.Log("Profiling one poll cycle on the fetch worker, the statistics follow when it completes")
+
+        # Poll the locations whose forecast is due, the fetch itself runs on the worker thread
+        now = time.time()
+        for location_code in self.location_codes:
+            if self.schedulers[location_code].due(now) and self.fetchWorker.request('fetch', location_code):
+                Domoticz.Debug(f"Forecast for location {location_code} due, fetching")
+
+        # Process forecasts the workers have completed since the previous heartbeat
+        for (job, location_code), data in self.fetchWorker.poll():
+            if job == 'profile':
+                self.reportProfile(data)
+                self.lastHealthUpdate = 0
+                continue
+            if isinstance(data, Exception):
+                Domoticz.Error(f"Error fetching forecast for location {location_code}: {str(data)}")
+                continue
+            if job == 'cache' and (data is None or location_code in self.forecasts):
+                continue  # nothing cached, or a fresh forecast was already shown
             Domoticz.Debug("time to update devices!!!!")
-            self.queryFromTo(self.deviceId, 1)
+            self.queryFromTo(self.deviceIds[location_code], 1)
             if data:
-                self.updateDevices(data)
+                self.updateDevices(data, location_code)
+            self.lastHealthUpdate = 0
 
-    def getData(self, location_code):
-        """Fetch solar forecast data from NED API"""
-        baseUrl = "https://api.ned.nl/v1/utilizations"
-        
-        headers = {
-            'X-AUTH-TOKEN': self.APIkey,
-            'accept': 'application/json'
-        }
-        
+        if time.time() - self.lastHealthUpdate >= self.healthInterval:
+            self.updateHealth()
+
+    def updateHealth(self):
+        """Show the plugin metrics on the health device"""
+        self.lastHealthUpdate = time.time()
+        for unit, pct in ((1, 50), (2, 90)):
+            latency = self.metrics.percentile('fetch', pct)
+            if latency is not None:
+                self.UpdateDevice(self.healthId, unit, 0, f"{latency:.0f}")
+        age = self.metrics.successAge()
+        if age is not None:
+            self.UpdateDevice(self.healthId, 3, 0, f"{age / 60:.0f}")
+        self.UpdateDevice(self.healthId, 4, 0, str(self.metrics.counter('api_errors')))
+        for line in self.metrics.summary():
+            Domoticz.Debug(line)
+
+    def profilePoll(self):
+        """Run on the fetch worker: fetch every location under cProfile, returns (profile, {location code: forecast})"""
+        import cProfile
+        profiler = cProfile.Profile()
+        forecasts = {}
+        profiler.enable()
+        try:
+            for location_code in self.location_codes:
+                forecasts[location_code] = self.getData(location_code, refresh=True)
+        finally:
+            profiler.disable()
+        return profiler, forecasts
+
+    def reportProfile(self, result):
+        """Write the forecasts of a profiled poll cycle to the devices, profiling that too, and dump the statistics to the plugin folder"""
+        import cProfile
+        import io
+        import pstats
+        if isinstance(result, Exception):
+            Domoticz.Error(f"Error profiling the poll cycle: {str(result)}")
+            return
+        fetchProfile, forecasts = result
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            for location_code, data in forecasts.items():
+                if data:
+                    self.updateDevices(data, location_code)
+        finally:
+            profiler.disable()
+        stream = io.StringIO()
+        stats = pstats.Stats(fetchProfile, stream=stream).add(profiler)
+        path = os.path.join(Parameters['HomeFolder'], f"profile-{datetime.now():%Y%m%d-%H%M%S}.prof")
+        try:
+            stats.dump_stats(path)
+            Domoticz.Log(f"Poll cycle profile written to {path}")
+        except OSError as e:
+            Domoticz.Error(f"Error writing profile: {str(e)}")
+        stats.sort_stats('cumulative').print_stats(20)
+        for line in stream.getvalue().splitlines():
+            Domoticz.Debug(line)
+
+    def requestParams(self, location_code):
+        """NED API query parameters for the forecast of today and tomorrow"""
         # Calculate date range: today and tomorrow
         today = date.today()
         tomorrow = today + timedelta(days=1)
@@ -179,25 +361,135 @@ class SolarForecastPlug:
         params = {
             'point': location_code,
             'type': 2,  # Solar
-            'granularity': 5,  # Hour granularity
+            'granularity': self.granularityCodes[self.granularity],  # Quarter hour or hour granularity
             'granularitytimezone': 1,  # CET (Central European Time)
             'classification': 1,  # Forecast
             'activity': 1,  # Providing (production)
             'validfrom[after]': str(today),
             'validfrom[strictly_before]': str(day_after)
         }
-        
+        return params
+
+    def readCache(self, params, latest=False):
+        """Return (age in seconds, data) from the forecast cache, or None"""
+        if self.forecastCache is None:
+            return None
         try:
-            response = requests.get(baseUrl, headers=headers, params=params)
-            response.raise_for_status()
-            data = response.json()
-            Domoticz.Debug(f"API call successful. URL: {response.url}")
-            return data
-        except requests.exceptions.RequestException as e:
+            if latest:
+                return self.forecastCache.latest(params)
+            return self.forecastCache.lookup(params)
+        except (sqlite3.Error, ValueError) as e:
+            Domoticz.Error(f"Error reading forecast cache: {str(e)}")
+            return None
+
+    def writeCache(self, params, data):
+        if self.forecastCache is None:
+            return
+        try:
+            self.forecastCache.put(params, data)
+            self.forecastCache.purge(7 * 24 * 3600)
+        except sqlite3.Error as e:
+            Domoticz.Error(f"Error writing forecast cache: {str(e)}")
+
+    def client(self):
+        """The NED API client, created on first use so requests is imported on the worker thread"""
+        with self.clientLock:
+            if self.stopped:
+                raise RuntimeError("Plugin is stopping, no NED client")
+            if self.nedClient is None:
+                # the request limit is per API key: share it with the other instances through the cache folder
+                bucketPath = os.path.join(self.forecastCache.lockFolder, 'ratelimit.json') if self.forecastCache is not None else None
+                self.nedClient = NedClient(self.APIkey, timeout=self.timeout, log=Domoticz.Debug, metrics=self.metrics, url=self.apiUrl, bucketPath=bucketPath)
+            return self.nedClient
+
+    def fetchJob(self, job, location_code):
+        """Run on the fetch worker: 'cache' returns the cached forecast of any age (or None), 'fetch' the current one, 'profile' see profilePoll"""
+        if self.stopped:
+            return None
+        if job == 'fetch':
+            return self.getData(location_code)
+        if job == 'profile':
+            return self.profilePoll()
+        if solarGeometry.np is not None:
+            self.sunTable.get()  # load NumPy and the sun table here instead of on the first heartbeat
+        cached = self.readCache(self.requestParams(location_code))
+        if cached is None:
+            return None
+        age, data = cached
+        Domoticz.Debug(f"Serving forecast for location {location_code} from cache ({int(age // 60)} minutes old)")
+        forecast = self.loadForecast(data, location_code)
+        self.schedulers[location_code].success(forecast.end, fetched=time.time() - age)
+        return forecast
+
+    def getData(self, location_code, refresh=False):
+        """Fetch the solar forecast (a Forecast) from NED API, served from the forecast cache while it is fresh (unless refresh is set)"""
+        params = self.requestParams(location_code)
+
+        if not refresh:
+            forecast = self.cachedForecast(location_code, params)
+            if forecast is not None:
+                return forecast
+        # other instances of the plugin on this host share the cache, only one of them fetches a request at a time
+        lock = self.forecastCache.fetchLock(params, cancel=self.client().stopping) if self.forecastCache is not None else contextlib.nullcontext(False)
+        with lock as locked:
+            if locked and not refresh:
+                forecast = self.cachedForecast(location_code, params)
+                if forecast is not None:
+                    Domoticz.Debug(f"Forecast for location {location_code} was fetched by another instance")
+                    self.metrics.count('shared_hits')
+                    return forecast
+            return self.fetchForecast(location_code, params)
+
+    def cachedForecast(self, location_code, params):
+        """The Forecast for the request parameters from the cache when it is fresh, or None
+
+        A forecast that does not cover tomorrow yet is only fresh for the scheduler's retry interval, so the
+        hourly check for tomorrow's forecast calls the NED API instead of reading back the incomplete copy.
+        """
+        cached = self.readCache(params)
+        if cached is None or cached[0] > self.cacheTTL:
+            return None
+        age, data = cached
+        scheduler = self.schedulers[location_code]
+        forecast = Forecast.load(data, log=Domoticz.Debug)
+        now = time.time()
+        if age >= scheduler.retry and (forecast.end is None or forecast.end < scheduler.horizon(now)):
+            Domoticz.Debug(f"Cached forecast for location {location_code} does not cover tomorrow ({int(age // 60)} minutes old), fetching")
+            return None
+        Domoticz.Debug(f"Forecast for location {location_code} served from cache ({int(age // 60)} minutes old)")
+        self.metrics.count('cache_hits')
+        self.metrics.success()
+        self.correctForecast(forecast, location_code)
+        scheduler.success(forecast.end, fetched=now - age, now=now)
+        return forecast
+
+    def fetchForecast(self, location_code, params):
+        """Fetch the Forecast for the request parameters from the NED API, falls back to the last cached one"""
+        try:
+            with self.metrics.timer('fetch'):
+                # each page is parsed and corrected while the next one is fetched, only the columns are kept
+                forecast = self.buildForecast(self.client().records(params, self.itemsPerPage), location_code)
+            Domoticz.Debug(f"API call successful, {len(forecast)} records for location {location_code}")
+            self.metrics.count('records', len(forecast))
+            self.metrics.success()
+            self.writeCache(params, forecast.columns())
+            self.schedulers[location_code].success(forecast.end)
+            return forecast
+        except (requests.exceptions.RequestException, ValueError) as e:
+            if self.stopped:
+                return None  # the fetch was aborted by onStop
             Domoticz.Error(f"Error calling NED API: {str(e)}")
+            self.metrics.count('api_errors')
+            delay = self.schedulers[location_code].failure()
+            Domoticz.Debug(f"Retrying location {location_code} in {int(delay // 60)} minutes")
+            # fall back to the last good forecast
+            cached = self.readCache(params, latest=True)
+            if cached is not None:
+                Domoticz.Log(f"NED API unreachable, using cached forecast from {int(cached[0] // 60)} minutes ago")
+                return self.loadForecast(cached[1], location_code)
             return False
 
-    def calculate_solar_correction(self, hour, capacity, location_code):
+    def calculate_solar_correction(self, hour, capacity, location_code, day_of_year=None):
         """
         Calculate solar position correction based on panel orientation and sun position.
         Converts API capacity to actual expected energy based on solar geometry.
@@ -205,77 +497,14 @@ class SolarForecastPlug:
         try:
             # Get location coordinates
             location = self.locations[location_code]
-            latitude = location['latitude']
-            longitude = location['longitude']
-            
-            # Solar position calculations
-            current_date = datetime.now()
-            day_of_year = current_date.timetuple().tm_yday
-            
-            # Calculate solar declination (angle of sun relative to equator)
-            angular_speed = 360 / 365.25
-            declination_rad = math.asin(0.3978 * math.sin(math.radians(angular_speed * 
-                            (day_of_year - (81 - 2 * math.sin(math.radians(angular_speed * (day_of_year - 2))))))))
-            declination = math.degrees(declination_rad)
-            
-            # Convert parameters to radians
-            lat_rad = math.radians(latitude)
-            lon_rad = math.radians(longitude)
-            decl_rad = math.radians(declination)
-            
-            # Time calculations
-            solar_hour = hour + (4 * longitude / 60)
-            hourly_angle = 15 * (12 - solar_hour)
-            hourly_angle_rad = math.radians(hourly_angle)
-            
-            # Calculate sun altitude and azimuth
-            sin_altitude = (math.sin(lat_rad) * math.sin(decl_rad) + 
-                           math.cos(lat_rad) * math.cos(decl_rad) * math.cos(hourly_angle_rad))
-            sin_altitude = max(-1, min(1, sin_altitude))  # Clamp to valid range
-            sun_altitude = math.degrees(math.asin(sin_altitude))
-            
-            # Sun azimuth calculation
-            cos_azimuth = ((math.sin(decl_rad) - math.sin(lat_rad) * math.sin(math.radians(sun_altitude))) / 
-                          (math.cos(lat_rad) * math.cos(math.radians(sun_altitude))))
-            cos_azimuth = max(-1, min(1, cos_azimuth))  # Clamp to valid range
-            sun_azimuth = math.degrees(math.acos(cos_azimuth))
-            
-            # Determine azimuth sign
-            sin_azimuth = (math.cos(decl_rad) * math.sin(hourly_angle_rad)) / math.cos(math.radians(sun_altitude))
-            if sin_azimuth < 0:
-                sun_azimuth = 360 - sun_azimuth
-            
-            # Calculate directional correction factors
+            if day_of_year is None:
+                day_of_year = datetime.now().timetuple().tm_yday
+
+            sun_altitude, sun_azimuth = solarGeometry.sunPosition(location['latitude'], location['longitude'], day_of_year, hour)
             correction = 0.0
-            
-            if capacity > 0 and sun_altitude > -2:
-                # Azimuth difference between sun and panel
-                az_diff = sun_azimuth - self.az
-                if az_diff > 180:
-                    az_diff = az_diff - 360
-                elif az_diff < -180:
-                    az_diff = az_diff + 360
-                
-                # Direct radiation factor based on azimuth
-                if az_diff >= -55:
-                    direct_factor = 1.0
-                elif az_diff >= -100:
-                    direct_factor = max(0.15, (az_diff + 100) / 45)
-                else:
-                    direct_factor = 0.1
-                
-                # Altitude factor (accounts for low sun angles)
-                if sun_altitude <= -2:
-                    alt_factor = 0
-                elif sun_altitude < 5:
-                    alt_factor = 0.15 + 0.85 * (sun_altitude + 2) / 7
-                else:
-                    alt_factor = 1.0
-                
-                direct_factor = direct_factor * alt_factor
-                diffuse_factor = 0.18 * alt_factor
-                correction = min(1.0, direct_factor + diffuse_factor)
-            
+            if capacity > 0:
+                correction = solarGeometry.correctionFactor(sun_altitude, sun_azimuth, self.az)
+
             # Calculate final energy in kWh
             kwh = self.kwp * (capacity / 100.0) * correction
             
@@ -287,63 +516,135 @@ class SolarForecastPlug:
             Domoticz.Error(f"Error calculating solar correction: {str(e)}")
             return 0.0
 
-    def updateDevices(self, data):
-        """Update devices with solar forecast data from NED API"""
+    def parseRecords(self, data):
+        """Pipeline stage: yield a Forecast per correctionChunk utilization records, the timestamps parsed per chunk"""
+        return Forecast.chunks(data, self.correctionChunk, log=Domoticz.Debug)
+
+    def correctRecords(self, chunks, location_code):
+        """Pipeline stage: yield the Forecast chunks with the expected kWh per panel array set"""
+        for chunk in chunks:
+            self.correctForecast(chunk, location_code)
+            yield chunk
+
+    def buildForecast(self, data, location_code):
+        """Stream utilization records through the parse and correct stages into one corrected Forecast"""
+        builder = ForecastBuilder()
+        for chunk in self.correctRecords(self.parseRecords(data), location_code):
+            builder.add(chunk)
+        return builder.build()
+
+    def loadForecast(self, data, location_code):
+        """Corrected Forecast of a cached forecast"""
+        forecast = Forecast.load(data, log=Domoticz.Debug)
+        self.correctForecast(forecast, location_code)
+        return forecast
+
+    def correctForecast(self, forecast, location_code):
+        """Set the expected kWh per panel array on the forecast, the sun positions are looked up once and reused for every array"""
+        with self.metrics.timer('correct'):
+            sun_altitude, sun_azimuth = self.sunTable.positions(location_code, forecast.dayOfYear(), forecast.hours())
+            # the capacity is a percentage of the peak power, the energy of a record scales with its length
+            forecast.setKwh([solarGeometry.correctPositions(sun_altitude, sun_azimuth, forecast.capacities, array['az'], array['kwp'] * forecast.step / 3600)
+                             for array in self.arrays])
+
+    def updateDevices(self, data, location_code):
+        """Update devices with solar forecast data, data is a Forecast or an iterable of NED utilization records"""
         try:
-            Domoticz.Debug(f"Processing {len(data)} data points from NED API")
+            Domoticz.Debug(f"Processing data points from NED API for location {location_code}")
             
-            # Track daily and hourly totals
-            daily_totals = {}
-            
-            if not isinstance(data, list):
+            if isinstance(data, (dict, str)):
                 Domoticz.Error("Unexpected data format from NED API")
                 return
+            if isinstance(data, Forecast):
+                forecast = data
+                if len(forecast.kwh) != len(self.arrays):
+                    self.correctForecast(forecast, location_code)
+            else:
+                forecast = self.buildForecast(data, location_code)
+            self.forecasts[location_code] = forecast
+            if self.forecastServer is not None:
+                self.publishForecast(location_code, forecast)
+            # the devices show hourly values, a quarter hour forecast is summed per hour
+            forecast = forecast.resample(3600)
+            count = len(forecast)
+            timestamps = forecast.timestamps()
+            deviceId = self.deviceIds[location_code]
+            # unit 1 is the (combined) forecast, units 2 and up the separate arrays when there is more than one
+            units = [1] + ([number + 1 for number in range(1, len(self.arrays) + 1)] if len(self.arrays) > 1 else [])
+            columns = [forecast.total] + (forecast.kwh if len(self.arrays) > 1 else [])
             
-            # Process each utilization record
-            for utilization in data:
-                try:
-                    validfrom = utilization.get('validfrom', '')
-                    capacity = utilization.get('capacity', 0)  # in percentage (0-100)
-                    
-                    if not validfrom:
-                        continue
-                    
-                    dateline = datetime.fromisoformat(validfrom)
-                    hour = dateline.hour
-                    
-                    # Apply solar position correction
-                    corrected_kwh = self.calculate_solar_correction(hour, capacity, self.location_code)
-                    
-                    # Calculate watts for display
-                    watts = int(corrected_kwh * 1000)  # Convert kWh to W
-                    
+            for unit, kwh in zip(units, columns):
+                written = self.lastWritten.get((deviceId, unit), {})
+                changed = []
+                for timestamp, value in zip(timestamps, kwh.tolist()):
                     # Build sValue: watts;wh;timestamp
-                    #sValue = f"{watts};{corrected_kwh:.3f};{validfrom}"
-                    sValue = f"{watts};{corrected_kwh:.3f};{dateline.strftime('%Y-%m-%d %H:%M:%S')}"
-                    
-                    #Domoticz.Debug(f"Updating device with: capacity={capacity}%, corrected_kwh={corrected_kwh:.3f}kWh, time={validfrom}")
-                    Domoticz.Debug(f"Updating device with: capacity={capacity}%, corrected_kwh={corrected_kwh:.3f}kWh, time={dateline.strftime('%Y-%m-%d %H:%M:%S')}")
-                    self.UpdateDevice(self.deviceId, 1, 0, sValue)
-                    
-                    # Track daily total
-                    day_key = dateline.date()
-                    if day_key not in daily_totals:
-                        daily_totals[day_key] = 0
-                    daily_totals[day_key] += corrected_kwh
-                    
-                except (KeyError, ValueError, TypeError) as e:
-                    Domoticz.Debug(f"Error processing utilization record: {str(e)}")
-                    continue
+                    sValue = f"{int(value * 1000)};{value:.3f};{timestamp}"
+                    # Only hours whose value changed since the last write go to Domoticz
+                    if written.get(timestamp) != sValue:
+                        changed.append((timestamp, sValue))
+                self.writeBatch(deviceId, unit, changed, count, min(timestamps) if timestamps else None)
             
-            Domoticz.Debug("successful data received and processed")
+            for day in forecast.days():
+                Domoticz.Debug(f"Forecast for {day} at location {location_code}: {forecast.dailyTotal(day):.3f} kWh")
+            Domoticz.Debug(f"Processed {count} data points for location {location_code}")
             
         except Exception as e:
             Domoticz.Error(f"Error updating devices: {str(e)}")
         
+    def publishIndex(self):
+        """Publish the list of forecast documents on the forecast server"""
+        self.forecastServer.publish('/', {
+            'locations': {location_code: {'name': self.locations[location_code]['name'],
+                                          'forecast': f"/forecast/{location_code}",
+                                          'arrays': [f"/forecast/{location_code}/{number}" for number in range(1, len(self.arrays) + 1)],
+                                          'updated': self.published.get(location_code)}
+                          for location_code in self.location_codes}
+        })
+
+    def publishForecast(self, location_code, forecast):
+        """Publish the corrected forecast of a location, combined and per panel array, on the forecast server"""
+        self.published[location_code] = datetime.now().astimezone().isoformat(timespec='seconds')
+        times = forecast.isoformat()
+        days = forecast.days()
+        document = {'location': location_code, 'name': self.locations[location_code]['name'], 'updated': self.published[location_code],
+                    'granularity': forecast.step // 60, 'unit': 'kWh', 'time': times}
+        self.forecastServer.publish(f"/forecast/{location_code}", dict(document,
+            arrays=self.arrays,
+            capacity=[round(value, 3) for value in forecast.capacities.tolist()],
+            kwh=[round(value, 4) for value in forecast.total.tolist()],
+            daily={str(day): round(forecast.dailyTotal(day), 3) for day in days}))
+        for number, (array, kwh) in enumerate(zip(self.arrays, forecast.kwh), 1):
+            self.forecastServer.publish(f"/forecast/{location_code}/{number}", dict(document,
+                array=array,
+                kwh=[round(value, 4) for value in kwh.tolist()],
+                daily={str(day): round(float(sum(kwh[start:stop])), 3) for day, (start, stop) in forecast.dayIndex.items()}))
+        self.publishIndex()
+
     def queryFromTo(self, Device, Unit):
         # see for which dates a device holds data
         Domoticz.Debug("the IDX should be "+ str(Devices[Device].Units[Unit].ID) + " for device " + str(Devices[Device].Units[Unit].Name))
 
+    def writeBatch(self, Device, Unit, values, total, oldest=None):
+        """Write the changed (timestamp, sValue) values of a unit in one go and remember what was written
+
+        oldest is the first timestamp of the whole forecast, remembered values before it are forgotten.
+        """
+        written = self.lastWritten.setdefault((Device, Unit), {})
+        start = time.perf_counter()
+        count = 0
+        for timestamp, sValue in values:
+            if self.UpdateDevice(Device, Unit, 0, sValue, AlwaysUpdate=True):
+                written[timestamp] = sValue
+                count += 1
+        elapsed = (time.perf_counter() - start) * 1000
+        self.metrics.record('write', elapsed)
+        self.metrics.count('writes', count)
+        # forget hours that dropped out of the forecast window
+        if oldest is not None:
+            for timestamp in [timestamp for timestamp in written if timestamp < oldest]:
+                del written[timestamp]
+        Domoticz.Log(f"Device '{Device}' unit {Unit}: wrote {count} of {total} values ({total - len(values)} unchanged) in {elapsed:.1f} ms")
+
     def UpdateDevice(self, Device, Unit, nValue, sValue, AlwaysUpdate=False, Name=""):
         # Make sure that the Domoticz device still exists (they can be deleted) before updating it
         if (Device in Devices and Unit in Devices[Device].Units):
@@ -358,10 +659,11 @@ class SolarForecastPlug:
                     if Name != "":
                         Devices[Device].Units[Unit].Name = Name
                     Devices[Device].Units[Unit].Update()
+                    return True
                     
         else:
             Domoticz.Error("trying to update a non-existent unit "+str(Unit)+" from device "+str(Device))
-        return
+        return False
         
 global _plugin
 _plugin = SolarForecastPlug()
@@ -383,6 +685,45 @@ def onHeartbeat():
     _plugin.onHeartbeat()
 
     # Generic helper functions
+def parseOptions(text):
+    """Parse 'key=value;key=value' into a dict with lower case keys"""
+    options = {}
+    for item in str(text).split(';'):
+        if '=' in item:
+            key, value = item.split('=', 1)
+            options[key.strip().lower()] = value.strip()
+    return options
+
+def parseArrays(declinations, azimuths, peakPowers):
+    """Combine the ';' separated declination, azimuth and peak power values into a list of panel arrays
+
+    A single value is used for all arrays, e.g. declination '35' with azimuth '-90;90'.
+    """
+    values = [str(declinations).split(';'), str(azimuths).split(';'), str(peakPowers).split(';')]
+    count = max(len(items) for items in values)
+    for items in values:
+        if len(items) == 1:
+            items *= count
+        elif len(items) != count:
+            Domoticz.Error(f"Panel settings do not all have {count} values, only using the first array")
+            count = 1
+    return [{'dec': int(dec), 'az': int(az), 'kwp': float(kwp)} for dec, az, kwp in zip(*(items[:count] for items in values))]
+
+def parseLocations(text, locations):
+    """Parse a ',' separated list of location codes or names into a list of known location codes"""
+    names = {location['name'].lower(): code for code, location in locations.items()}
+    codes = []
+    for item in str(text).split(','):
+        item = item.strip()
+        code = item if item in locations else names.get(item.lower())
+        if code is None:
+            if item:
+                Domoticz.Error(f"Unknown location '{item}' ignored")
+            continue
+        if code not in codes:
+            codes.append(code)
+    return codes
+
 def DumpConfigToLog():
     Domoticz.Debug("Parameter count: " + str(len(Parameters)))
     for x in Parameters:
@@ -400,3 +741,6 @@ def DumpConfigToLog():
     for x in Devices:
         Domoticz.Debug("Device:           " + str(x) + " - " + str(Devices[x]))
     return
+
+# ms it took to load this module, reported by onStart
+importTime = (time.perf_counter() - importStart) * 1000
@@ -0,0 +1,77 @@
+#
+#   Poll scheduler for the NED solar forecast plugin
+#
+#   Author: Jan-Jaap Kostelijk
+#
+#   Keeps track of when the forecast of a location needs to be fetched again:
+#   a fresh forecast that covers today and tomorrow is refreshed after the
+#   refresh interval, an incomplete one (tomorrow not yet published) is checked
+#   again sooner and failed fetches back off exponentially. Because the next
+#   fetch is an absolute moment, missed heartbeats are caught up on the first
+#   heartbeat after them. Outcomes are reported from the fetch worker threads,
+#   so all state is guarded by a lock.
+#
+import random
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+class PollScheduler:
+    """Decides when the forecast of one location needs to be fetched"""
+
+    def __init__(self, refresh=3 * 3600, retry=3600, backoff=300, maxBackoff=3600):
+        self.refresh = refresh  # seconds a complete forecast is used before it is refreshed
+        self.retry = min(retry, refresh)  # seconds before an incomplete forecast is checked again
+        self.backoff = backoff  # first wait after a failed fetch, doubled on every next failure
+        self.maxBackoff = maxBackoff
+        self.nextDue = 0.0
+        self.fetched = None  # moment the forecast in use was fetched from the NED API
+        self.coverage = None  # moment up to which the forecast in use has data
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def horizon(now):
+        """Moment the forecast needs to cover: the end of tomorrow (local time)"""
+        day_after = date.fromtimestamp(now) + timedelta(days=2)
+        return time.mktime(datetime.combine(day_after, datetime.min.time()).timetuple())
+
+    def covered(self, now):
+        return self.coverage is not None and self.coverage >= self.horizon(now)
+
+    def due(self, now=None):
+        """True when the forecast needs to be fetched"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if now < self.nextDue:
+                return False
+            if self.failures == 0 and self.fetched is not None and self.covered(now) and now - self.fetched < self.refresh:
+                # the forecast in use is fresh and covers the horizon, no need to call the API
+                self.nextDue = self.fetched + self.refresh
+                return False
+            return True
+
+    def success(self, coverage, fetched=None, now=None):
+        """Record a forecast covering up to coverage (epoch seconds), fetched at fetched (default now)"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.failures = 0
+            self.coverage = coverage
+            self.fetched = now if fetched is None else fetched
+            if self.covered(now):
+                self.nextDue = self.fetched + self.refresh
+            else:
+                self.nextDue = now + self.retry
+
+    def failure(self, now=None):
+        """Record a failed fetch and back off, returns the seconds until the next attempt"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.failures += 1
+            delay = min(self.maxBackoff, self.backoff * 2 ** (self.failures - 1))
+            delay = random.uniform(delay / 2, delay)
+            self.nextDue = now + delay
+            return delay
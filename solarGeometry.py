@@ -0,0 +1,226 @@
+#
+#   Solar geometry for the NED solar forecast plugin
+#
+#   Author: Jan-Jaap Kostelijk
+#
+#   Sun position and panel orientation correction, both as scalar functions
+#   (one record at a time) and as a batch engine that corrects a whole forecast
+#   in one NumPy pass. The batch engine falls back to the scalar functions when
+#   NumPy is not installed.
+#
+#   SunTable keeps the sun positions per (location, day of year, hour) in memory
+#   (and optionally on disk) so corrections become a table lookup.
+#
+import hashlib
+import math
+import os
+
+from lazyModule import lazyImport
+
+np = lazyImport('numpy')  # None when NumPy is not installed
+
+ANGULAR_SPEED = 360 / 365.25
+MODEL_VERSION = 1  # bump when the sun position model changes, invalidates stored sun tables
+
+def solarDeclination(day_of_year):
+    """Declination of the sun in degrees (angle relative to the equator)"""
+    return math.degrees(math.asin(0.3978 * math.sin(math.radians(ANGULAR_SPEED *
+                        (day_of_year - (81 - 2 * math.sin(math.radians(ANGULAR_SPEED * (day_of_year - 2)))))))))
+
+def sunPosition(latitude, longitude, day_of_year, hour):
+    """Return (altitude, azimuth) of the sun in degrees"""
+    lat_rad = math.radians(latitude)
+    decl_rad = math.radians(solarDeclination(day_of_year))
+
+    # Time calculations
+    solar_hour = hour + (4 * longitude / 60)
+    hourly_angle_rad = math.radians(15 * (12 - solar_hour))
+
+    # Sun altitude
+    sin_altitude = (math.sin(lat_rad) * math.sin(decl_rad) +
+                    math.cos(lat_rad) * math.cos(decl_rad) * math.cos(hourly_angle_rad))
+    sin_altitude = max(-1, min(1, sin_altitude))  # Clamp to valid range
+    sun_altitude = math.degrees(math.asin(sin_altitude))
+
+    # Sun azimuth
+    cos_azimuth = ((math.sin(decl_rad) - math.sin(lat_rad) * math.sin(math.radians(sun_altitude))) /
+                   (math.cos(lat_rad) * math.cos(math.radians(sun_altitude))))
+    cos_azimuth = max(-1, min(1, cos_azimuth))  # Clamp to valid range
+    sun_azimuth = math.degrees(math.acos(cos_azimuth))
+
+    # Determine azimuth sign
+    sin_azimuth = (math.cos(decl_rad) * math.sin(hourly_angle_rad)) / math.cos(math.radians(sun_altitude))
+    if sin_azimuth < 0:
+        sun_azimuth = 360 - sun_azimuth
+    return sun_altitude, sun_azimuth
+
+def correctionFactor(sun_altitude, sun_azimuth, panel_azimuth):
+    """Fraction (0..1) of the regional capacity a panel with the given azimuth receives"""
+    if sun_altitude <= -2:
+        return 0.0
+
+    # Azimuth difference between sun and panel
+    az_diff = sun_azimuth - panel_azimuth
+    if az_diff > 180:
+        az_diff = az_diff - 360
+    elif az_diff < -180:
+        az_diff = az_diff + 360
+
+    # Direct radiation factor based on azimuth
+    if az_diff >= -55:
+        direct_factor = 1.0
+    elif az_diff >= -100:
+        direct_factor = max(0.15, (az_diff + 100) / 45)
+    else:
+        direct_factor = 0.1
+
+    # Altitude factor (accounts for low sun angles)
+    if sun_altitude < 5:
+        alt_factor = 0.15 + 0.85 * (sun_altitude + 2) / 7
+    else:
+        alt_factor = 1.0
+
+    return min(1.0, direct_factor * alt_factor + 0.18 * alt_factor)
+
+def sunPositions(latitude, longitude, days_of_year, hours):
+    """Vectorized sunPosition: arrays of day of year and (fractional) hour in, arrays of altitude and azimuth out"""
+    if np is None:
+        positions = [sunPosition(latitude, longitude, day, hour) for day, hour in zip(days_of_year, hours)]
+        return [altitude for altitude, azimuth in positions], [azimuth for altitude, azimuth in positions]
+
+    days = np.asarray(days_of_year, dtype=np.float64)
+    hours = np.asarray(hours, dtype=np.float64)
+    lat_rad = math.radians(latitude)
+
+    decl_rad = np.arcsin(0.3978 * np.sin(np.radians(ANGULAR_SPEED *
+                         (days - (81 - 2 * np.sin(np.radians(ANGULAR_SPEED * (days - 2))))))))
+    hourly_angle_rad = np.radians(15 * (12 - (hours + 4 * longitude / 60)))
+
+    sin_decl = np.sin(decl_rad)
+    cos_decl = np.cos(decl_rad)
+    sin_altitude = np.clip(math.sin(lat_rad) * sin_decl + math.cos(lat_rad) * cos_decl * np.cos(hourly_angle_rad), -1, 1)
+    altitude_rad = np.arcsin(sin_altitude)
+    cos_altitude = np.cos(altitude_rad)
+
+    cos_azimuth = np.clip((sin_decl - math.sin(lat_rad) * sin_altitude) / (math.cos(lat_rad) * cos_altitude), -1, 1)
+    azimuth = np.degrees(np.arccos(cos_azimuth))
+    sin_azimuth = cos_decl * np.sin(hourly_angle_rad) / cos_altitude
+    azimuth = np.where(sin_azimuth < 0, 360 - azimuth, azimuth)
+    return np.degrees(altitude_rad), azimuth
+
+def correctionFactors(sun_altitude, sun_azimuth, panel_azimuth):
+    """Vectorized correctionFactor"""
+    az_diff = np.asarray(sun_azimuth) - panel_azimuth
+    az_diff = np.where(az_diff > 180, az_diff - 360, np.where(az_diff < -180, az_diff + 360, az_diff))
+    direct_factor = np.where(az_diff >= -55, 1.0,
+                             np.where(az_diff >= -100, np.maximum(0.15, (az_diff + 100) / 45), 0.1))
+    alt_factor = np.where(sun_altitude <= -2, 0.0,
+                          np.where(sun_altitude < 5, 0.15 + 0.85 * (sun_altitude + 2) / 7, 1.0))
+    return np.minimum(1.0, (direct_factor + 0.18) * alt_factor)
+
+def correctPositions(sun_altitude, sun_azimuth, capacities, panel_azimuth, kwp):
+    """Expected energy in kWh for every record given the sun positions and capacities (percentage 0..100)"""
+    if np is None:
+        kwh = []
+        for altitude, azimuth, capacity in zip(sun_altitude, sun_azimuth, capacities):
+            correction = 0.0
+            if capacity > 0:
+                correction = correctionFactor(altitude, azimuth, panel_azimuth)
+            kwh.append(kwp * (capacity / 100.0) * correction)
+        return kwh
+
+    capacities = np.asarray(capacities, dtype=np.float64)
+    correction = np.where(capacities > 0, correctionFactors(sun_altitude, sun_azimuth, panel_azimuth), 0.0)
+    return kwp * (capacities / 100.0) * correction
+
+def correctBatch(latitude, longitude, days_of_year, hours, capacities, panel_azimuth, kwp):
+    """Expected energy in kWh for every record of a forecast
+
+    days_of_year, hours and capacities (percentage 0..100) are equally long sequences,
+    returns a sequence of kWh values of the same length.
+    """
+    sun_altitude, sun_azimuth = sunPositions(latitude, longitude, days_of_year, hours)
+    return correctPositions(sun_altitude, sun_azimuth, capacities, panel_azimuth, kwp)
+
+class SunTable:
+    """Sun altitude and azimuth per (location, day of year, hour), built on first use
+
+    The table is a float32 array of shape (locations, 366, 24, 2). When a path is given
+    it is stored there and reused as long as the model version and locations match.
+    """
+
+    def __init__(self, locations, path=None):
+        self.locations = locations
+        self.path = path
+        self.codes = {code: index for index, code in enumerate(sorted(locations, key=int))}
+        self.table = None
+
+    def fingerprint(self):
+        text = f"{MODEL_VERSION};" + ";".join(f"{code}:{self.locations[code]['latitude']}:{self.locations[code]['longitude']}" for code in self.codes)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def build(self):
+        days, hours = np.meshgrid(np.arange(1, 367), np.arange(24), indexing='ij')
+        table = np.empty((len(self.codes), 366, 24, 2), dtype=np.float32)
+        for code, index in self.codes.items():
+            altitude, azimuth = sunPositions(self.locations[code]['latitude'], self.locations[code]['longitude'], days, hours)
+            table[index, :, :, 0] = altitude
+            table[index, :, :, 1] = azimuth
+        return table
+
+    def load(self):
+        """Read the stored table, returns None when it is missing or outdated"""
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        try:
+            with np.load(self.path) as stored:
+                if str(stored['fingerprint']) != self.fingerprint():
+                    return None
+                return stored['table']
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save(self, table):
+        if self.path is None:
+            return
+        temp = self.path + ".tmp"
+        with open(temp, 'wb') as f:
+            np.savez(f, fingerprint=self.fingerprint(), table=table)
+        os.replace(temp, self.path)
+
+    def get(self):
+        """Return the table, loading or building (and storing) it when needed"""
+        if self.table is None:
+            table = self.load()
+            if table is None:
+                table = self.build()
+                try:
+                    self.save(table)
+                except OSError:
+                    pass
+            self.table = table
+        return self.table
+
+    def positions(self, location_code, days_of_year, hours):
+        """Return (altitudes, azimuths) for the records, from the table, interpolated between the hours for fractional hours"""
+        location = self.locations[location_code]
+        if np is None:
+            return sunPositions(location['latitude'], location['longitude'], days_of_year, hours)
+        table = self.get()[self.codes[location_code]]
+        hours = np.asarray(hours, dtype=np.float64)
+        days = np.asarray(days_of_year, dtype=np.intp) - 1
+        whole = np.floor(hours)
+        positions = table[days, whole.astype(np.intp) % 24].astype(np.float64)
+        weight = hours - whole
+        if not weight.any():
+            return positions[:, 0], positions[:, 1]
+        # the hour after 23:00 is midnight of the next day
+        following = table[(days + (whole >= 23)) % 366, (whole.astype(np.intp) + 1) % 24].astype(np.float64)
+        altitude = positions[:, 0] + weight * (following[:, 0] - positions[:, 0])
+        turn = (following[:, 1] - positions[:, 1] + 180) % 360 - 180  # shortest way round, azimuth wraps at 360
+        azimuth = (positions[:, 1] + weight * turn) % 360
+        return altitude, azimuth
+
+    def correct(self, location_code, days_of_year, hours, capacities, panel_azimuth, kwp):
+        """Expected energy in kWh for every record, see correctBatch"""
+        return correctPositions(*self.positions(location_code, days_of_year, hours), capacities, panel_azimuth, kwp)